@@ -31,6 +31,7 @@
 import time
 from woodstove.app import app
 from woodstove.common import logger
+from woodstove.db import stormy, cache, profiler
 
 
 def ping(job=None):  # pylint: disable=W0613
@@ -42,7 +43,7 @@ def ping(job=None):  # pylint: disable=W0613
 class Debug(app.App):
     ''' debug app '''
 
-    @app.get('/ping')
+    @app.get('/ping', retry=False)
     def ping(self):
         '''
          Create a job and put it on the queue
@@ -63,3 +64,35 @@ class Debug(app.App):
         Get current server time
         '''
         return self.response(int(time.time()))
+
+    @app.get('/pool')
+    def pool(self):
+        '''
+        Get database connection pool counters
+        '''
+        self.auth()
+        return self.response(stormy.pool_stats())
+
+    @app.get('/cache')
+    def identity_cache(self):
+        '''
+        Get identity cache counters
+        '''
+        self.auth()
+        return self.response(cache.stats())
+
+    @app.get('/queries')
+    def queries(self):
+        '''
+        Get the query profiles of the most recent routes
+        '''
+        self.auth()
+        return self.response(profiler.recent())
+
+    @app.get('/statements')
+    def statements(self):
+        '''
+        Get compiled statement cache counters
+        '''
+        self.auth()
+        return self.response(stormy.statement_stats())
@@ -40,13 +40,16 @@ class Job(app.CRUDApp):
     crud_klass = job.Job
     crud_key_name = 'uuid'
     crud_key_type = unicode
+    # Lets pollers of /job/:key get a 304 instead of the job again. Jobs are
+    # changed outside of the CRUD routes, so If-Match is not supported.
+    crud_read_etag = True
 
     @app.get('/mine')
     def job_list_mine(self):
         ''' List jobs owed by the user making the call '''
         self.auth()
         user = self.get_user()
-        return self.response(user.jobs)
+        return self.stream_response(user.jobs)
 
     @app.get('/:key/children')
     def job_get_children(self, key):
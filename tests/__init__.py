@@ -0,0 +1,174 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+'''
+Tests for woodstove.
+
+The tests run against a sqlite database in a temporary directory, the
+configuration is written there before woodstove is imported. Run them from
+the top of the tree with:
+
+    python -m unittest discover -s tests -t .
+'''
+
+
+import os
+import json
+import shutil
+import atexit
+import tempfile
+import cStringIO
+from wsgiref.util import setup_testing_defaults
+
+
+TEST_DIR = tempfile.mkdtemp(prefix='woodstove-test-')
+atexit.register(shutil.rmtree, TEST_DIR, True)
+
+with open(os.path.join(TEST_DIR, 'woodstove.yml'), 'w') as conf:
+    conf.write('storm:\n'
+               ' dsn: sqlite:%s\n'
+               ' debug: false\n' % os.path.join(TEST_DIR, 'test.db'))
+
+os.environ['WOODSTOVE_PATH'] = TEST_DIR
+
+
+import unittest
+from woodstove.app import app
+from woodstove.db import stormy
+
+
+MIXIN_DIR = os.path.join(os.path.dirname(app.__file__), 'mixin')
+
+
+def load_mixin(name):
+    '''
+    Load an app mixin. The mixins use the route decorators of
+    L{woodstove.app.app} without importing them, so they are run in a copy of
+    its namespace.
+
+    @param name: Name of the mixin module, e.g. crud.
+    @return: C{dict} of the names defined by the mixin.
+    '''
+    namespace = dict(vars(app))
+    namespace['__name__'] = 'woodstove.app.mixin.%s' % name
+    execfile(os.path.join(MIXIN_DIR, '%s.py' % name), namespace)
+    return namespace
+
+
+crud = load_mixin('crud')
+
+
+class CRUDApp(crud['CRUD'], app.App):
+    ''' CRUD App for the tests '''
+    crud_auth = False
+
+
+class TestCase(unittest.TestCase):
+    '''
+    Test case with a fresh sqlite table per test and a WSGI client for an
+    app.
+
+    @cvar schema: C{list} of statements creating the tables of the test.
+    @cvar tables: Tables to drop after each test.
+    @cvar app_class: App to mount for L{call}, or None.
+    '''
+
+    schema = ()
+    tables = ()
+    app_class = None
+
+    def setUp(self):
+        self.addCleanup(self.drop_tables)
+        store = stormy.Stormy()
+
+        for statement in self.schema:
+            store.execute(statement)
+
+        store.commit()
+        self.application = None
+
+        if self.app_class is not None:
+            self.application = self.app_class().mount()
+
+    def drop_tables(self):
+        ''' Drop L{tables}, also if the test failed to set up '''
+        store = stormy.Stormy()
+        store.rollback()
+
+        for table in self.tables:
+            store.execute('DROP TABLE IF EXISTS %s' % table)
+
+        store.commit()
+
+    def call(self, method, path, body=None, headers=None):
+        '''
+        Call a route of L{app_class}.
+
+        @param method: HTTP verb.
+        @param path: Path of the route, with the query string.
+        @keyword body: Object to send as JSON body.
+        @keyword headers: C{dict} of request headers.
+        @return: (status code, C{dict} of headers with lower case names,
+            decoded body) tuple.
+        '''
+        environ = {}
+        setup_testing_defaults(environ)
+        data = json.dumps(body) if body is not None else ''
+        path, _, query = path.partition('?')
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(data)),
+            'wsgi.input': cStringIO.StringIO(data),
+        })
+
+        for name, value in (headers or {}).items():
+            environ['HTTP_%s' % name.upper().replace('-', '_')] = value
+
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [int(status.split()[0]),
+                            dict((name.lower(), value)
+                                 for name, value in headers)]
+
+        output = ''.join(self.application(environ, start_response))
+        return response[0], response[1], json.loads(output) if output else None
+
+    def query(self, statement):
+        '''
+        Run a query on its own and commit.
+
+        @param statement: SQL statement.
+        @return: C{list} of rows.
+        '''
+        store = stormy.Stormy()
+        rows = list(store.execute(statement))
+        store.commit()
+        return rows
@@ -0,0 +1,80 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+''' Tests for the route machinery '''
+
+
+from woodstove import plugin
+from woodstove.app import app
+import tests
+
+
+class RoutePipelineTest(tests.TestCase):
+    ''' Route hooks are resolved into the pipeline '''
+
+    def setUp(self):
+        super(RoutePipelineTest, self).setUp()
+        self.calls = []
+
+    def _enter(self, func, args, kwargs):
+        self.calls.append(func.__name__)
+
+    def test_rebuild(self):
+        pipeline = app.RoutePipeline().build()
+        self.assertTrue(pipeline.empty)
+        plugin.register_hook('route', 'enter', self._enter)
+
+        try:
+            self.assertEqual(pipeline.current().enter, (self._enter,))
+            self.assertFalse(pipeline.empty)
+            self.assertEqual(pipeline.generation, plugin.hook_generation())
+        finally:
+            plugin.remove_hook('route', 'enter', self._enter)
+
+        self.assertTrue(pipeline.current().empty)
+
+    def test_route(self):
+        class HookApp(app.App):
+            ''' App with one route '''
+
+            @app.get('/')
+            def index(self):
+                ''' Route for the test '''
+                return {'ok': True}
+
+        self.application = HookApp().mount()
+        plugin.register_hook('route', 'enter', self._enter)
+
+        try:
+            status, _, body = self.call('GET', '/')
+        finally:
+            plugin.remove_hook('route', 'enter', self._enter)
+
+        self.assertEqual((status, body), (200, {'ok': True}))
+        self.assertEqual(self.calls, ['index'])
+        self.call('GET', '/')
+        self.assertEqual(self.calls, ['index'])
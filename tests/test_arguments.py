@@ -0,0 +1,72 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+''' Tests for argument specs '''
+
+
+from storm.locals import Storm, Int, Unicode
+from woodstove import exceptions
+from woodstove.app import arguments
+import tests
+
+
+class Gizmo(Storm):
+    ''' Storm class for the tests '''
+    __storm_table__ = 'gizmo'
+    id = Int(primary=True)
+    name = Unicode()
+
+
+class StormToSpecTest(tests.TestCase):
+    ''' storm_to_spec hands out copies of a cached spec '''
+
+    def test_copies(self):
+        first = arguments.storm_to_spec(Gizmo)
+        second = arguments.storm_to_spec(Gizmo)
+        self.assertFalse(first is second)
+        self.assertEqual(sorted(first.args), ['id', 'name'])
+        self.assertTrue(first.compile() is second.compile())
+
+    def test_update(self):
+        spec = arguments.storm_to_spec(Gizmo)
+        spec.compile()
+        spec.update({'size': arguments.Integer('size')})
+        spec.compile()
+        self.assertEqual(spec.validate({'size': 1}), {'size': 1})
+        self.assertRaises(exceptions.ArgumentException,
+                          arguments.storm_to_spec(Gizmo).validate,
+                          {'size': 1})
+
+    def test_change_args(self):
+        spec = arguments.storm_to_spec(Gizmo)
+        del spec.args['name']
+        spec.compile()
+        self.assertRaises(exceptions.ArgumentException, spec.validate,
+                          {'name': u'a'})
+        other = arguments.storm_to_spec(Gizmo)
+        other.compile()
+        self.assertEqual(other.validate({'name': u'a'}), {'name': u'a'})
@@ -0,0 +1,125 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+''' Tests for the bulk routes of the CRUD mixin '''
+
+
+from storm.locals import Storm, Int, Unicode
+from woodstove import plugin
+from woodstove.db import stormy
+import tests
+
+
+class Widget(Storm):
+    ''' Storm class for the tests '''
+    __storm_table__ = 'widget'
+    id = Int(primary=True)
+    name = Unicode()
+    version = stormy.version(Int())
+
+
+class WidgetApp(tests.CRUDApp):
+    ''' CRUD App for widgets '''
+    crud_klass = Widget
+    crud_key_name = 'id'
+    crud_etag = True
+
+
+class BulkTest(tests.TestCase):
+    ''' /_bulk routes '''
+
+    schema = [
+        'CREATE TABLE widget (id INTEGER PRIMARY KEY, name TEXT UNIQUE,'
+        ' version INTEGER)',
+        "INSERT INTO widget VALUES (1, 'a', 1), (2, 'b', 1), (3, 'c', 1)",
+    ]
+    tables = ['widget']
+    app_class = WidgetApp
+
+    def setUp(self):
+        super(BulkTest, self).setUp()
+        self.hooks = []
+        plugin.register_hook(Widget, 'delete.postcommit', self._hook)
+
+    def tearDown(self):
+        plugin.remove_hook(Widget, 'delete.postcommit', self._hook)
+        super(BulkTest, self).tearDown()
+
+    def _hook(self, obj, storage=None):
+        self.hooks.append(obj.id)
+
+    def test_delete(self):
+        status, _, body = self.call('POST', '/_bulk/delete', [1, 9, 3])
+        self.assertEqual(status, 200)
+        self.assertEqual([(item['index'], item['status'])
+                          for item in body['data']],
+                         [(0, 200), (1, 404), (2, 200)])
+        self.assertEqual(body['data'][0]['data'], {
+            'id': 1, 'name': 'a', 'version': 1})
+        self.assertEqual(self.hooks, [1, 3])
+        self.assertEqual(self.query('SELECT id FROM widget'), [(2,)])
+
+    def test_delete_invalid_key(self):
+        status, _, body = self.call('POST', '/_bulk/delete', ['x', 2])
+        self.assertEqual(status, 200)
+        self.assertEqual([item['status'] for item in body['data']],
+                         [400, 200])
+        self.assertEqual(self.query('SELECT id FROM widget ORDER BY id'),
+                         [(1,), (3,)])
+
+    def test_create(self):
+        status, _, body = self.call('POST', '/_bulk', [
+            {'id': 4, 'name': u'd'}, {'name': u'a'}, {'name': 5}])
+        self.assertEqual(status, 200)
+        self.assertEqual([item['status'] for item in body['data']],
+                         [201, 409, 400])
+        self.assertEqual(body['data'][0]['data']['name'], 'd')
+        self.assertEqual(self.query('SELECT id FROM widget ORDER BY id'),
+                         [(1,), (2,), (3,), (4,)])
+
+    def test_update(self):
+        status, _, body = self.call('POST', '/_bulk/update', [
+            {'id': 1, 'name': u'x'}, {'id': 2, 'name': u'c'},
+            {'id': 9, 'name': u'z'}, {'name': u'y'}])
+        self.assertEqual(status, 200)
+        self.assertEqual([item['status'] for item in body['data']],
+                         [200, 409, 404, 400])
+        self.assertEqual(body['data'][0]['data'], {
+            'id': 1, 'name': 'x', 'version': 2})
+        self.assertEqual(self.query('SELECT * FROM widget ORDER BY id'),
+                         [(1, 'x', 2), (2, 'b', 1), (3, 'c', 1)])
+
+    def test_update_if_match(self):
+        status, _, body = self.call('POST', '/_bulk/update', [
+            {'id': 1, 'name': u'x', '_etag': '"1"'},
+            {'id': 2, 'name': u'y', '_etag': '"5"'},
+            {'id': 3, 'name': u'z', '_etag': 'W/"1"'}])
+        self.assertEqual(status, 200)
+        self.assertEqual([item['status'] for item in body['data']],
+                         [200, 412, 412])
+        self.assertEqual(self.query('SELECT * FROM widget ORDER BY id'),
+                         [(1, 'x', 2), (2, 'b', 1), (3, 'c', 1)])
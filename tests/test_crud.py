@@ -0,0 +1,88 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+''' Tests for the single record CRUD routes '''
+
+
+from storm.locals import Storm, Int, Unicode
+from woodstove import plugin
+import tests
+
+
+class Item(Storm):
+    ''' Storm class for the tests '''
+    __storm_table__ = 'item'
+    id = Int(primary=True)
+    name = Unicode()
+    size = Int()
+
+
+class ItemApp(tests.CRUDApp):
+    ''' CRUD App for items '''
+    crud_klass = Item
+    crud_key_name = 'id'
+
+
+class ReplaceTest(tests.TestCase):
+    ''' PUT replaces a record or creates it '''
+
+    schema = [
+        'CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT, size INTEGER)',
+        "INSERT INTO item VALUES (1, 'a', 5)",
+    ]
+    tables = ['item']
+    app_class = ItemApp
+
+    def setUp(self):
+        super(ReplaceTest, self).setUp()
+        self.hooks = []
+        plugin.register_hook(Item, 'create.postcommit', self._created)
+        plugin.register_hook(Item, 'replace.preremove', self._removed)
+
+    def tearDown(self):
+        plugin.remove_hook(Item, 'create.postcommit', self._created)
+        plugin.remove_hook(Item, 'replace.preremove', self._removed)
+        super(ReplaceTest, self).tearDown()
+
+    def _created(self, obj, storage=None):
+        self.hooks.append(('created', obj.id))
+
+    def _removed(self, obj, storage=None):
+        self.hooks.append(('removed', obj.id))
+
+    def test_replace(self):
+        status, _, body = self.call('PUT', '/1', {'name': u'b'})
+        self.assertEqual(status, 200)
+        self.assertEqual(body['data'], [{'id': 1, 'name': 'b', 'size': None}])
+        self.assertEqual(self.hooks, [('removed', 1), ('created', 1)])
+        self.assertEqual(self.query('SELECT * FROM item'), [(1, 'b', None)])
+
+    def test_create(self):
+        status, _, body = self.call('PUT', '/2', {'name': u'b', 'size': 1})
+        self.assertEqual(status, 201)
+        self.assertEqual(body['data'], [{'id': 2, 'name': 'b', 'size': 1}])
+        self.assertEqual(self.hooks, [('created', 2)])
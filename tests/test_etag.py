@@ -0,0 +1,144 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+''' Tests for ETags and If-Match on the CRUD routes '''
+
+
+from storm.locals import Storm, Int, Unicode, JSON
+from woodstove.db import stormy
+import tests
+
+
+class Doc(Storm):
+    ''' Storm class with a version column '''
+    __storm_table__ = 'doc'
+    id = Int(primary=True)
+    name = Unicode()
+    version = stormy.version(Int())
+
+
+class Note(Storm):
+    ''' Storm class without a version column '''
+    __storm_table__ = 'note'
+    id = Int(primary=True)
+    name = Unicode()
+    tags = JSON()
+
+
+class DocApp(tests.CRUDApp):
+    ''' CRUD App for docs '''
+    crud_klass = Doc
+    crud_key_name = 'id'
+    crud_etag = True
+
+
+class NoteApp(tests.CRUDApp):
+    ''' CRUD App for notes '''
+    crud_klass = Note
+    crud_key_name = 'id'
+    crud_etag = True
+
+
+class VersionTest(tests.TestCase):
+    ''' If-Match against a version column '''
+
+    schema = [
+        'CREATE TABLE doc (id INTEGER PRIMARY KEY, name TEXT,'
+        ' version INTEGER)',
+        "INSERT INTO doc VALUES (1, 'a', 1)",
+    ]
+    tables = ['doc']
+    app_class = DocApp
+
+    def test_read(self):
+        status, headers, _ = self.call('GET', '/1')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['etag'], '"1"')
+        status, _, _ = self.call('GET', '/1', headers={'If-None-Match': '"1"'})
+        self.assertEqual(status, 304)
+
+    def test_update(self):
+        status, headers, body = self.call('POST', '/1', {'name': u'b'},
+                                          {'If-Match': '"1"'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['etag'], '"2"')
+        self.assertEqual(body['data'][0]['version'], 2)
+        status, _, _ = self.call('POST', '/1', {'name': u'c'},
+                                 {'If-Match': '"1"'})
+        self.assertEqual(status, 412)
+        self.assertEqual(self.query('SELECT * FROM doc'), [(1, 'b', 2)])
+
+    def test_weak(self):
+        status, _, _ = self.call('PATCH', '/1', {'name': u'b'},
+                                 {'If-Match': 'W/"1"'})
+        self.assertEqual(status, 412)
+        status, _, _ = self.call('PATCH', '/1', {'name': u'b'},
+                                 {'If-Match': '*'})
+        self.assertEqual(status, 200)
+
+    def test_replace(self):
+        status, headers, _ = self.call('PUT', '/1', {'name': u'b'},
+                                       {'If-Match': '"0", "1"'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['etag'], '"2"')
+        status, _, _ = self.call('PUT', '/2', {'name': u'b'},
+                                 {'If-Match': '"1"'})
+        self.assertEqual(status, 412)
+
+    def test_concurrent(self):
+        doc = stormy.Stormy().get(Doc, 1)
+        guard = stormy.version_guard(doc)
+        self.query("UPDATE doc SET version = 2")
+        self.assertFalse(stormy.update_if(stormy.Stormy(), doc,
+                                          {Doc.name: u'b'}, guard))
+
+
+class HashTest(tests.TestCase):
+    ''' If-Match against a hash of the row '''
+
+    schema = [
+        'CREATE TABLE note (id INTEGER PRIMARY KEY, name TEXT, tags TEXT)',
+        "INSERT INTO note VALUES (1, 'a', '{\"b\": 1, \"a\": [0.1]}')",
+    ]
+    tables = ['note']
+    app_class = NoteApp
+
+    def test_update(self):
+        _, headers, _ = self.call('GET', '/1')
+        etag = headers['etag']
+        status, headers, _ = self.call('POST', '/1', {'name': u'b'},
+                                       {'If-Match': etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers['etag'], etag)
+        status, _, _ = self.call('POST', '/1', {'name': u'c'},
+                                 {'If-Match': etag})
+        self.assertEqual(status, 412)
+        self.assertEqual(self.query('SELECT name FROM note'), [('b',)])
+
+    def test_guard(self):
+        self.assertTrue(stormy.version_guard(stormy.Stormy().get(Note, 1))
+                        is None)
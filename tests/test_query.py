@@ -0,0 +1,162 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+''' Tests for stormy.Query and the find functions '''
+
+
+import json
+import urllib
+from storm.locals import Storm, Int, Unicode
+from woodstove import exceptions
+from woodstove.db import stormy, generic
+import tests
+
+
+class Gadget(Storm):
+    ''' Storm class for the tests '''
+    __storm_table__ = 'gadget'
+    id = Int(primary=True)
+    name = Unicode()
+    size = Int()
+
+
+class GadgetApp(tests.CRUDApp):
+    ''' CRUD App for gadgets '''
+    crud_klass = Gadget
+    crud_key_name = 'id'
+
+
+class StatementCacheTest(tests.TestCase):
+    ''' Filtered queries run from the compiled statement cache '''
+
+    schema = [
+        'CREATE TABLE gadget (id INTEGER PRIMARY KEY, name TEXT,'
+        ' size INTEGER)',
+        "INSERT INTO gadget VALUES (1, 'a', 10), (2, 'b', 20), (3, 'c', 30),"
+        " (4, 'd', 40)",
+    ]
+    tables = ['gadget']
+    app_class = GadgetApp
+
+    def test_hit(self):
+        generic.find(Gadget, {'size': {'gt': 15}}, sort='id')
+        stats = stormy.statement_stats()
+        page, total = generic.find(Gadget, {'size': {'gt': 25}}, sort='id')
+        self.assertEqual(stormy.statement_stats()['hits'],
+                         stats['hits'] + 2)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(page), 2)
+        self.assertEqual([x.id for x in page], [3, 4])
+        self.assertEqual([x.id for x in page], [3, 4])
+
+    def test_limit_offset(self):
+        for _ in range(2):
+            page, total = generic.find(Gadget, {'size': {'gt': 0}},
+                                       offset=1, limit=2, sort='id')
+            self.assertEqual([x.id for x in page], [2, 3])
+            self.assertEqual(total, 4)
+
+    def test_projection(self):
+        for _ in range(2):
+            page, _ = generic.find(Gadget, {'name': u'b'}, fields=['name'])
+            self.assertEqual(page, [{'name': 'b'}])
+
+    def test_uncached(self):
+        query = stormy.Query(Gadget)
+        query.filter({'size': {'gt': 15}})
+        query.where = Gadget.size < 35
+        stats = stormy.statement_stats()
+        page, _ = query.execute()
+        self.assertEqual(sorted(x.id for x in page), [1, 2, 3])
+        self.assertEqual(stormy.statement_stats()['hits'], stats['hits'])
+
+    def test_route(self):
+        where = urllib.quote(json.dumps({'size': {'lt': 25}}))
+
+        for _ in range(2):
+            status, _, body = self.call('GET', '/?sort=id&where=%s' % where)
+            self.assertEqual(status, 200)
+            self.assertEqual(body['total'], 2)
+            self.assertEqual([x['id'] for x in body['data']], [1, 2])
+
+
+class KeysetTest(tests.TestCase):
+    ''' Keyset pagination with find_page '''
+
+    schema = [
+        'CREATE TABLE gadget (id INTEGER PRIMARY KEY, name TEXT,'
+        ' size INTEGER)',
+        "INSERT INTO gadget VALUES (1, 'a', 10), (2, 'b', 20), (3, 'c', 20),"
+        " (4, 'd', 30), (5, 'e', 20)",
+    ]
+    tables = ['gadget']
+    app_class = GadgetApp
+
+    def pages(self, **kwargs):
+        ''' Ids of every page of find_page '''
+        pages = []
+        cursor = None
+
+        while True:
+            page, cursor = generic.find_page(Gadget, cursor=cursor, limit=2,
+                                             **kwargs)
+            pages.append([x['id'] if isinstance(x, dict) else x.id
+                          for x in page])
+
+            if cursor is None:
+                return pages
+
+    def test_key(self):
+        self.assertEqual(self.pages(), [[1, 2], [3, 4], [5]])
+
+    def test_sort_ties(self):
+        self.assertEqual(self.pages(sort='size'), [[1, 2], [3, 5], [4]])
+        self.assertEqual(self.pages(sort='-size'), [[4, 5], [3, 2], [1]])
+
+    def test_where_fields(self):
+        self.assertEqual(self.pages(where={'size': 20}, fields=['id'],
+                                    sort='-id'), [[5, 3], [2]])
+
+    def test_full_page(self):
+        page, cursor = generic.find_page(Gadget, limit=5)
+        self.assertEqual(len(page), 5)
+        self.assertTrue(cursor is None)
+
+    def test_invalid(self):
+        self.assertRaises(exceptions.RequestException, generic.find_page,
+                          Gadget, cursor='x', limit=2)
+        status, _, _ = self.call('GET', '/?limit=2&cursor=x')
+        self.assertEqual(status, 400)
+
+    def test_route(self):
+        status, _, body = self.call('GET', '/?limit=3&sort=size&cursor=')
+        self.assertEqual(status, 200)
+        self.assertEqual([x['id'] for x in body['data']], [1, 2, 3])
+        status, _, body = self.call('GET', '/?limit=3&sort=size&cursor=%s'
+                                    % urllib.quote(body['next_cursor']))
+        self.assertEqual([x['id'] for x in body['data']], [5, 4])
+        self.assertTrue(body['next_cursor'] is None)
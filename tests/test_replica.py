@@ -0,0 +1,120 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+''' Tests for routing reads to replicas '''
+
+
+import os
+from storm.locals import Storm, Int, Unicode
+from woodstove.db import stormy, generic
+import tests
+
+
+class Part(Storm):
+    ''' Storm class for the tests '''
+    __storm_table__ = 'part'
+    id = Int(primary=True)
+    name = Unicode()
+
+
+class PartApp(tests.CRUDApp):
+    ''' CRUD App for parts '''
+    crud_klass = Part
+    crud_key_name = 'id'
+
+
+SCHEMA = 'CREATE TABLE part (id INTEGER PRIMARY KEY, name TEXT)'
+
+
+class ReplicaTest(tests.TestCase):
+    ''' Reads go to a replica unless the data was just written '''
+
+    schema = [SCHEMA, "INSERT INTO part VALUES (1, 'primary')"]
+    tables = ['part']
+    app_class = PartApp
+
+    def setUp(self):
+        super(ReplicaTest, self).setUp()
+        dsn = 'sqlite:%s' % os.path.join(tests.TEST_DIR, 'replica.db')
+        self.pool = stormy._create_pool(dsn, {})
+        store = self.pool.checkout()
+        store.execute(SCHEMA)
+        store.execute("INSERT INTO part VALUES (1, 'replica')")
+        store.commit()
+        self.pool.checkin(store)
+        stormy.Stormy._replicas = (self.pool,)
+        stormy.__written__.pop(Part, None)
+
+    def tearDown(self):
+        stormy.Stormy().release()
+        stormy.Stormy._replicas = ()
+        store = self.pool.checkout()
+        store.execute('DROP TABLE part')
+        store.commit()
+        self.pool.checkin(store)
+        super(ReplicaTest, self).tearDown()
+
+    def names(self):
+        ''' Names found by generic.find '''
+        return [x.name for x in generic.find(Part)[0]]
+
+    def test_read(self):
+        self.assertEqual(self.names(), ['replica'])
+
+    def test_flushed_write(self):
+        state = stormy.Stormy()
+        part = Part()
+        part.name = u'new'
+        # Added to the storm store directly, only the flush tells.
+        state.store.add(part)
+        state.find(Part).count()
+        self.assertFalse(state.store._dirty)
+        self.assertTrue(state.writing())
+        self.assertEqual(self.names(), ['primary', 'new'])
+        self.assertFalse(stormy._reset_reader())
+        state.commit()
+        self.assertFalse(state.writing())
+        self.assertTrue(Part in stormy.__written__)
+        self.assertEqual(self.names(), ['primary', 'new'])
+
+    def test_window(self):
+        stormy.__written__[Part] = 0
+        self.assertEqual(self.names(), ['replica'])
+        state = stormy.Stormy()
+        state.mark_written(Part)
+        state.commit()
+        self.assertEqual(self.names(), ['primary'])
+
+    def test_route(self):
+        status, _, body = self.call('GET', '/')
+        self.assertEqual(status, 200)
+        self.assertEqual([x['name'] for x in body['data']], ['replica'])
+        status, _, _ = self.call('POST', '/', {'name': u'new'})
+        self.assertEqual(status, 201)
+        status, _, body = self.call('GET', '/')
+        self.assertEqual([x['name'] for x in body['data']],
+                         ['primary', 'new'])
@@ -28,6 +28,8 @@
 ''' woodstove.app '''
 
 
+import json
+import bottle
 from woodstove.db import stormy
 
 
@@ -44,13 +46,14 @@ def add_app(app):
     __apps__.append(app)
 
 
-def response(data, total=None):
+def response(data, total=None, **extra):
     '''
     Format api response.
 
     @param data: Data being returned to client.
     @keyword total: Number of records being returned. len(data) will be used if
         this is not specified.
+    @keyword **extra: Additional keys for the response object.
     @return: API response dict.
     '''
     try:
@@ -71,5 +74,75 @@ def response(data, total=None):
 
     res = {'data': data,
            'total': total}
+    res.update(extra)
 
     return res
+
+
+def stream_response(data, total=None, encode=None, chunk_size=100):
+    '''
+    Format api response as an iterator of JSON chunks.
+
+    Unlike L{response} the records are converted and encoded a chunk at a time
+    while the response body is written, so a large result set is never held
+    in memory as a whole. The query behind a storm result set runs when the
+    body is sent, after the route has returned.
+
+    @param data: Iterable of records being returned to client.
+    @keyword total: Number of records being returned. The records are counted
+        while streaming if this is not specified.
+    @keyword encode: Function used to convert each record. Storm objects are
+        converted with L{stormy.storm_to_dict} if this is not specified.
+    @keyword chunk_size: Number of records to encode per chunk.
+    @return: Iterator of response body strings.
+    '''
+    bottle.response.content_type = 'application/json'
+
+    if encode is None:
+        encode = _encode_record
+
+    return _stream(data, total, encode, chunk_size)
+
+
+def _encode_record(record):
+    '''
+    Convert a record to something json can encode.
+
+    @param record: Record to convert.
+    @return: C{dict} for storm objects, L{record} otherwise.
+    '''
+    try:
+        return stormy.storm_to_dict(record)
+    except TypeError:
+        return record
+
+
+def _stream(data, total, encode, chunk_size):
+    '''
+    Generator behind L{stream_response}.
+
+    @param data: Iterable of records.
+    @param total: Number of records or None to count them.
+    @param encode: Record conversion function.
+    @param chunk_size: Number of records to encode per chunk.
+    '''
+    count = 0
+    chunk = []
+    yield '{"data": ['
+
+    for record in data:
+        chunk.append(json.dumps(encode(record)))
+
+        if len(chunk) >= chunk_size:
+            yield (', ' if count else '') + ', '.join(chunk)
+            count += len(chunk)
+            chunk = []
+
+    if chunk:
+        yield (', ' if count else '') + ', '.join(chunk)
+        count += len(chunk)
+
+    if total is None:
+        total = count
+
+    yield '], "total": %s}' % json.dumps(total)
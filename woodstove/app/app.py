@@ -28,7 +28,9 @@
 ''' App Class '''
 
 import sys
+import types
 import inspect
+import calendar
 import bottle
 import functools
 import collections
@@ -37,7 +39,7 @@ from woodstove.app import arguments, exhandlers
 from woodstove.auth import user, adapter
 from woodstove.async import dispatcher
 from woodstove.common import logger, context
-from woodstove.db import stormy
+from woodstove.db import stormy, profiler
 
 
 # pylint: disable=C0103
@@ -87,48 +89,57 @@ def _call_route_setup_hooks(func, spec, kwargs):
     plugin.call_hooks('route', 'setup', func, spec, kwargs)
 
 
-def _call_route_enter_hooks(func, args, kwargs):
+class RoutePipeline(object):
     '''
-
-    @param func:
-    @param spec:
-    @param kwargs:
+    Route hook dispatch chain.
+
+    The 'route' hooks are resolved into tuples when the pipeline is built so
+    calling a route does not have to search the hook tables. The pipeline is
+    rebuilt when the plugin hook tables change.
+
+    @ivar generation: Plugin hook generation the pipeline was built from.
+    @ivar context: Tuple of 'context' hooks.
+    @ivar enter: Tuple of 'enter' hooks.
+    @ivar exit: Tuple of 'exit' hooks.
+    @ivar exception: Tuple of 'exception' hooks.
+    @ivar empty: True if there are no hooks to run at all.
     '''
-    plugin.call_hooks('route', 'enter', func, args, kwargs)
-
+    generation = None
+    context = ()
+    enter = ()
+    exit = ()
+    exception = ()
+    empty = True
 
-def _call_route_exit_hooks(func, args, kwargs, ret):
-    '''
-
-    @param func:
-    @param spec:
-    @param kwargs:
-    @param ret:
-    '''
-    plugin.call_hooks('route', 'exit', func, args, kwargs, ret)
-
-
-def _call_route_exception_hooks(func, args, kwargs, ret):
-    '''
+    def build(self):
+        '''
+        Resolve the route hooks from the plugin hook tables.
 
-    @param func:
-    @param spec:
-    @param kwargs:
-    @param ret:
-    '''
-    plugin.call_hooks('route', 'exception', func, args, kwargs, ret)
+        @return: This pipeline.
+        '''
+        # Read first and set last, a change of the hook tables while
+        # building or a route called before the hooks are set causes another
+        # rebuild instead of a pipeline with stale hooks.
+        generation = plugin.hook_generation()
+        self.context = plugin.get_hooks('route', 'context')
+        self.enter = plugin.get_hooks('route', 'enter')
+        self.exit = plugin.get_hooks('route', 'exit')
+        self.exception = plugin.get_hooks('route', 'exception')
+        self.empty = not (self.context or self.enter or self.exit or
+                          self.exception)
+        self.generation = generation
+        return self
 
+    def current(self):
+        '''
+        Get the pipeline, rebuilding it first if the hook tables changed.
 
-def _call_route_context_hooks(func, args, kwargs, ctx, request):
-    '''
+        @return: This pipeline.
+        '''
+        if self.generation != plugin.hook_generation():
+            self.build()
 
-    @param func:
-    @param spec:
-    @param kwargs:
-    @param ctx:
-    @param request:
-    '''
-    plugin.call_hooks('route', 'context', func, args, kwargs, ctx, request)
+        return self
 
 
 def route(method, path, **kwargs):  # pylint: disable=R0912
@@ -137,7 +148,10 @@ def route(method, path, **kwargs):  # pylint: disable=R0912
 
     @param method: HTTP verb.
     @param path: URL path spec.
-    @param **kwargs: Additional arguments that router hooks may need.
+    @param **kwargs: Additional arguments that router hooks may need. Pass
+        readonly=True to run the route against a read replica. GET routes are
+        called again on a new database connection if the connection is lost,
+        pass retry=False to turn that off, or retry=True for other methods.
     @return: Returns decorator function.
     '''
     def decorator(func):
@@ -152,6 +166,11 @@ def route(method, path, **kwargs):  # pylint: disable=R0912
 
         _call_route_setup_hooks(func, spec, kwargs)
 
+        pipeline = RoutePipeline()
+        readonly = kwargs.get('readonly', False)
+        retry = kwargs.get('retry', method == 'GET')
+        name = '%s.%s' % (func.__module__, func.__name__)
+
         @functools.wraps(func)
         def closure(*args, **kwargs):
             '''
@@ -161,34 +180,57 @@ def route(method, path, **kwargs):  # pylint: disable=R0912
             @param **kwargs: Keyword arguments for L{func}.
             @return: API response object.
             '''
+            hooks = pipeline.current()
             ctx = {}
-            _call_route_context_hooks(func, args, kwargs, ctx, bottle.request)
+
+            if not hooks.empty:
+                plugin.run_hooks(hooks.context, func, args, kwargs, ctx,
+                                 bottle.request)
 
             with context.Context(**ctx):
                 logger.Logger(__name__).debug("Calling: %s(%r, %r)" % (
                                               func.__name__, args, kwargs))
                 ret = None
-                _call_route_enter_hooks(func, args, kwargs)
-
-                try:
-                    # If we get here with a pending transaction we don't want
-                    # to keep it so doing a rollback here. A side effect of
-                    # this is that if we've lost the database connection the
-                    # rollback call will trigger a reconnect.
-                    stormy.Stormy().rollback()
 
-                    try:
-                        ret = func(*args, **kwargs)
-                    except BaseException as execp:
-                        _call_route_exception_hooks(func, args, kwargs, execp)
-                        raise
+                if not hooks.empty:
+                    plugin.run_hooks(hooks.enter, func, args, kwargs)
 
-                    _call_route_exit_hooks(func, args, kwargs, ret)
-                except Exception as execp:
-                    ret = exhandlers.run_exc_handler(execp, func)
+                # The database session is only set up if the route actually
+                # uses the database.
+                with stormy.Session(readonly) as session, \
+                        profiler.Profile(name) as profile:
+                    call = func
 
-                return ret
+                    if retry:
+                        call = functools.partial(stormy.call_with_retries,
+                                                 func, session.reset)
 
+                    try:
+                        if hooks.empty:
+                            ret = call(*args, **kwargs)
+                        else:
+                            try:
+                                ret = call(*args, **kwargs)
+                            except BaseException as execp:
+                                plugin.run_hooks(hooks.exception, func, args,
+                                                 kwargs, execp)
+                                raise
+
+                            plugin.run_hooks(hooks.exit, func, args, kwargs,
+                                             ret)
+                    except Exception as execp:
+                        ret = exhandlers.run_exc_handler(execp, func)
+
+                    for header, value in profile.headers():
+                        bottle.response.set_header(header, value)
+
+                    # Streamed responses keep the session until they are sent.
+                    if isinstance(ret, types.GeneratorType):
+                        ret = session.stream(ret)
+
+                    return ret
+
+        closure.pipeline = pipeline
         return closure
 
     return decorator
@@ -209,11 +251,27 @@ def put(path, **kwargs):
     return route('PUT', path, **kwargs)
 
 
+def patch(path, **kwargs):
+    ''' patch => route(method='PATCH') '''
+    return route('PATCH', path, **kwargs)
+
+
 def delete(path, **kwargs):
     ''' delete => route(method='DELETE') '''
     return route('DELETE', path, **kwargs)
 
 
+def _etag_opaque(tag):
+    '''
+    Strip the weak prefix off an ETag for weak comparison.
+
+    @param tag: ETag from a header.
+    @return: Opaque tag.
+    '''
+    tag = tag.strip()
+    return tag[2:] if tag.startswith('W/') else tag
+
+
 class App(object):
     '''
     App class
@@ -248,6 +306,7 @@ class App(object):
         for name, attr in inspect.getmembers(self):
             try:
                 bapp.route(attr.route.path, attr.route.verb, callback=attr)
+                attr.pipeline.build()
             except AttributeError:
                 if isinstance(attr, App):
                     attr.mount(bapp)
@@ -256,6 +315,7 @@ class App(object):
             for key, arglist in self.argfmt.iteritems():
                 if not isinstance(arglist, arguments.ArgumentList):
                     self.argfmt[key] = arguments.storm_to_spec(arglist)
+                self.argfmt[key].compile()
         except AttributeError:
             pass
 
@@ -266,10 +326,68 @@ class App(object):
         '''
         API Response
 
-        @return: Formated api response object.
+        @return: Formated api response object, an empty body if
+            L{not_modified} set the status to 304.
         '''
+        if bottle.response.status_code == 304:
+            return ''
+
         return app.response(*args, **kwargs)
 
+    @classmethod
+    def stream_response(cls, *args, **kwargs):
+        '''
+        Streaming API Response
+
+        @return: Iterator of JSON chunks making up the api response object,
+            an empty body if L{not_modified} set the status to 304.
+        '''
+        if bottle.response.status_code == 304:
+            return ''
+
+        return app.stream_response(*args, **kwargs)
+
+    @classmethod
+    def not_modified(cls, etag=None, last_modified=None):
+        '''
+        Set the ETag and Last-Modified headers and check them against the
+        If-None-Match or If-Modified-Since header of the request. If the
+        client's copy is current the status is set to 304 and the route
+        should return without a body.
+
+        @keyword etag: Quoted ETag, may be weak.
+        @keyword last_modified: UTC C{datetime} of the last change.
+        @return: True if the client's copy is current.
+        '''
+        headers = bottle.request.headers
+
+        if etag is not None:
+            bottle.response.set_header('ETag', etag)
+
+        if last_modified is not None:
+            bottle.response.set_header('Last-Modified',
+                                       bottle.http_date(last_modified))
+
+        none_match = headers.get('If-None-Match')
+        since = headers.get('If-Modified-Since')
+
+        # If-None-Match takes precedence and uses the weak comparison.
+        if none_match is not None:
+            current = etag is not None and any(
+                tag.strip() == '*' or _etag_opaque(tag) == _etag_opaque(etag)
+                for tag in none_match.split(','))
+        elif since and last_modified is not None:
+            since = bottle.parse_date(since)
+            current = since is not None and since >= calendar.timegm(
+                last_modified.utctimetuple())
+        else:
+            current = False
+
+        if current:
+            cls.set_status(304)
+
+        return current
+
     @classmethod
     def body(cls):
         '''
@@ -280,6 +398,40 @@ class App(object):
         body = bottle.request.json
         return body if body else dict()
 
+    @classmethod
+    def body_lines(cls, max_line=1048576):
+        '''
+        Iterate over the lines of the HTTP body as they are read from the
+        client, without holding the whole body in memory.
+
+        @keyword max_line: Longest line allowed in bytes, not counting the
+            newline.
+        @return: Iterator of body lines.
+        @raise RequestException: When a line is longer than L{max_line}. The
+            rest of the body is not read.
+        '''
+        environ = bottle.request.environ
+        stream = environ['wsgi.input']
+        remaining = environ.get('CONTENT_LENGTH')
+        remaining = int(remaining) if remaining else None
+
+        while remaining is None or remaining > 0:
+            size = max_line + 1
+            line = stream.readline(size if remaining is None
+                                   else min(size, remaining))
+
+            if not line:
+                break
+
+            if len(line) == size and not line.endswith('\n'):
+                raise exceptions.RequestException(
+                    'Line longer than %d bytes' % max_line)
+
+            if remaining is not None:
+                remaining -= len(line)
+
+            yield line
+
     @classmethod
     def query(cls):
         '''
@@ -347,7 +499,8 @@ class App(object):
         '''
         '''
         creds = self.get_creds()
-        user_obj = stormy.Stormy().find(user.User, name=creds.name).one()
+        store = stormy.Stormy().reader(user.User)
+        user_obj = store.find(user.User, name=creds.name).one()
 
         if user_obj is None:
             raise exceptions.AuthException("bad user")
@@ -386,7 +539,7 @@ class App(object):
         return dispatcher.add_job(func, args, kwargs, user=user_obj)
 
     def validate(self, expected, actual=None, chktype=True, logging=True,
-                 func=None):
+                 func=None, partial=False):
         '''
         Validate input arguments.
 
@@ -395,10 +548,14 @@ class App(object):
         @keyword chktype:
         @keyword logging:
         @keyword func:
+        @keyword partial: Only check the arguments present in L{actual}.
         @return:
         @raise ArugmentException:
         '''
         if actual is None:
             actual = self.body()
 
+        if partial:
+            return expected.validate_partial(actual, func, chktype)
+
         return expected.validate(actual, func, chktype)
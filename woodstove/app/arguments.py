@@ -46,12 +46,14 @@ Argument validator
 import re
 import traceback
 import copy
+from storm.info import get_cls_info
 from woodstove import exceptions
 from woodstove.common import logger
 from woodstove.db import stormy
 
 
 __sentinel__ = object()
+__specs__ = dict()
 
 
 class ArgumentList(object):
@@ -60,7 +62,14 @@ class ArgumentList(object):
 
     @ivar args: C{dict} of argument specifications.
     @type args: C{dict}
+    @ivar frozen: Shared lists are frozen and can not be updated, use
+        L{copy} to get a list that can be changed.
     '''
+    frozen = False
+    _validator = None
+    _partial_validator = None
+    _source = None
+
     def __init__(self, arg_list=None):
         '''
         Setup the argument list by converting the L{arg_list} argument into a
@@ -95,19 +104,122 @@ class ArgumentList(object):
             verified.
         @raise ArgumentException: Raised if any argument does not match spec.
         '''
+        if self._validator is not None:
+            return self._validator(args, func, check_type)
+
         self.unknown(args)
         for arg in self.args.itervalues():
             arg.check(args, func, check_type)
 
         return args
 
+    def validate_partial(self, args, func=None, check_type=True):
+        '''
+        Verify only the arguments present in L{args}. Missing arguments are
+        not required and do not get their defaults, for partial updates.
+
+        @param args: The argument C{dict} passed in by the user.
+        @keyword func: The function calling validate.
+        @keyword check_type: Should the type of the passed in values be
+            verified.
+        @raise ArgumentException: Raised if any argument does not match spec.
+        '''
+        if self._partial_validator is not None:
+            return self._partial_validator(args, func, check_type)
+
+        self.unknown(args)
+        for key in args.keys():
+            self.args[key].check(args, func, check_type)
+
+        return args
+
+    def compile(self):
+        '''
+        Generate validation functions specialized for this spec and use them
+        in L{validate} and L{validate_partial} from now on. Nested argument
+        lists are compiled too. The functions raise the same exceptions as
+        the hook based validation. Call compile again after changing the
+        spec.
+
+        @return: The validation function. It takes the same arguments as
+            L{validate}.
+        '''
+        if self.frozen and self._validator is not None:
+            return self._validator
+
+        source = self._source
+
+        # Copies of a frozen list share its validators until they change.
+        if source is not None and self.args == source.args:
+            self._validator = source.compile()
+            self._partial_validator = source._partial_validator
+            return self._validator
+
+        self._validator = self._compile()
+        self._partial_validator = self._compile(partial=True)
+        return self._validator
+
+    def _compile(self, partial=False):
+        '''
+        Generate the source of a validation function and compile it.
+
+        @keyword partial: Skip missing arguments, like L{validate_partial}.
+        @return: The validation function.
+        '''
+        namespace = {
+            'ArgumentException': exceptions.ArgumentException,
+            'log_hook_error': _log_hook_error,
+            'KEYS': frozenset(self.args),
+        }
+        lines = [
+            'def validate(args, func=None, check_type=True):',
+            '    for key in args:',
+            '        if key not in KEYS:',
+            '            raise ArgumentException("Unknown argument in input")',
+        ]
+
+        for index, arg in enumerate(self.args.itervalues()):
+            lines.extend(_compile_argument(arg, 'a%d' % index, namespace,
+                                           partial))
+
+        lines.append('    return args')
+        source = '\n'.join(lines) + '\n'
+        exec compile(source, '<ArgumentList %x>' % id(self), 'exec') in namespace
+        return namespace['validate']
+
     def update(self, mapping):
         '''
         Add the contents of L{mapping} to this argument list.
 
         @param mapping: C{dict} of arguments to add.
+        @raise InternalException: If the list is frozen.
         '''
+        if self.frozen:
+            raise exceptions.InternalException("Can not update a frozen "
+                                               "ArgumentList, copy it first")
+
         self.args.update(mapping)
+        self._validator = None
+        self._partial_validator = None
+
+    def copy(self, mapping=None):
+        '''
+        Make a copy of this argument list that can be changed. The
+        L{Argument} objects are shared with the original list, replace them
+        instead of changing them. Copies of a frozen list reuse its compiled
+        validators in L{compile} as long as their arguments are the same.
+
+        @keyword mapping: C{dict} of arguments to add to the copy.
+        @return: New unfrozen ArgumentList.
+        '''
+        new = type(self)()
+        new.args = dict(self.args)
+        new._source = self if self.frozen else self._source
+
+        if mapping:
+            new.args.update(mapping)
+
+        return new
 
     def __deepcopy__(self, memo):
         '''
@@ -117,7 +229,7 @@ class ArgumentList(object):
         @return: New copy of this ArugmentList
         '''
         new = type(self)()
-        new.args = copy.deepcopy(self.__dict__, memo)
+        new.args = copy.deepcopy(self.args, memo)
         return new
 
 
@@ -363,11 +475,201 @@ class List(Argument):
                                                        subtype)
 
 
+def _log_hook_error(hook):
+    '''
+    Log an unexpected exception raised by a validation hook.
+
+    @param hook: The hook that raised the exception.
+    '''
+    logger.Logger(__name__).error("Exception in hook %r: %s" % (
+        hook, traceback.format_exc()))
+
+
+def _compile_argument(arg, prefix, namespace, partial=False):
+    '''
+    Generate the source lines that check one argument for
+    L{ArgumentList.compile}.
+
+    @param arg: L{Argument} to generate code for.
+    @param prefix: Unique prefix for the names added to L{namespace}.
+    @param namespace: Globals of the generated function. Objects used by the
+        generated code are added to it.
+    @keyword partial: Skip the argument when it is missing instead of
+        requiring it or setting its default.
+    @return: C{list} of source lines.
+    '''
+    def ref(name, obj):
+        '''
+        Add L{obj} to the namespace and return the name it is bound to.
+        '''
+        name = '%s_%s' % (prefix, name)
+        namespace[name] = obj
+        return name
+
+    # Subclasses that replace check() are called as they are.
+    if type(arg).check not in (Argument.check, Hook.check):
+        call = '%s.check(args, func, check_type)' % ref('arg', arg)
+
+        if partial:
+            return ['    if %s in args:' % ref('key', arg.key),
+                    '        ' + call]
+
+        return ['    ' + call]
+
+    key = ref('key', arg.key)
+    check_type = 'False' if isinstance(arg, Hook) else 'check_type'
+    lines = ['    try:',
+             '        value = args[%s]' % key,
+             '    except KeyError:']
+    indent = '        '
+
+    if arg.required_funcs is not None and not partial:
+        lines.append('        if func in %s:' % ref('required',
+                                                       arg.required_funcs))
+        indent += '    '
+
+    if partial:
+        lines.append('%spass' % indent)
+    elif not arg.optional:
+        message = 'Missing required argument: %s' % arg.key
+        lines.append('%sraise ArgumentException(%s)' % (indent,
+                                                        ref('missing', message)))
+    elif arg.default is not __sentinel__:
+        lines.append('%sargs[%s] = %s' % (indent, key,
+                                           ref('default', arg.default)))
+    else:
+        lines.append('%spass' % indent)
+
+    if not arg.hooks:
+        return lines
+
+    lines.extend(['    else:',
+                  '        try:'])
+    # Hooks all get the original value and the last one to run sets the
+    # argument. Results equal to the original value only need storing once
+    # an earlier hook has replaced the value.
+    dirty = False
+
+    for index, (hook, opts) in enumerate(arg.hooks.iteritems()):
+        name = '%d' % index
+        indent = '            '
+        body = ['hook = %s' % ref('hook' + name, hook)]
+        result = 'value'
+
+        if hook is hook_type:
+            if check_type != 'False':
+                types = ref('types' + name, arg.type)
+                body.extend([
+                    'if check_type is not False and '
+                    'type(value) not in %s:' % types,
+                    '    raise ArgumentException("%%s: %%r is not %%r" %% '
+                    '(%s, type(value), %s))' % (key, types)])
+        elif hook is hook_regex:
+            pattern = ref('pattern' + name, opts['private'])
+            result = 'text'
+            body.extend([
+                'text = unicode(value)',
+                'if %s.search(text) is None:' % pattern,
+                '    raise ArgumentException("%%s: %%r does not match regex '
+                '%%s" %% (%s, text, %s))' % (key, pattern)])
+        elif hook is hook_recurse:
+            nested = ref('nested' + name, arg.type.compile())
+            result = 'nested'
+            body.append('nested = %s(value, %s)' % (nested, check_type))
+        elif hook is hook_seq_type:
+            types = ref('types' + name, opts['private'])
+            body.extend([
+                'for item in value:',
+                '    if type(item) not in %s:' % types,
+                '        raise ArgumentException("%%s: %%r is not %%r" %% (%s, '
+                'type(item), %s))' % (key, types)])
+        elif hook is hook_seq_recurse:
+            nested = ref('nested' + name, opts['private'].compile())
+            body.extend([
+                'for index in xrange(len(value)):',
+                '    value[index] = %s(value[index], %s)' % (nested,
+                                                             check_type)])
+        else:
+            result = 'result'
+            body.append('result = %s(%s, value, func, {"private": %s, '
+                        '"funcs": %s, "check_type": %s})' % (
+                            ref('hook' + name, hook), ref('spec', arg),
+                            ref('private' + name, opts['private']),
+                            ref('funcs' + name, opts['funcs']), check_type))
+
+        if result != 'value' or dirty:
+            body.append('args[%s] = %s' % (key, result))
+
+            if result != 'value':
+                dirty = True
+            elif not opts['funcs']:
+                dirty = False
+
+        if opts['funcs']:
+            lines.append('%sif func in %s:' % (indent,
+                                               ref('funcs' + name, opts['funcs'])))
+            indent += '    '
+
+        lines.extend(indent + line for line in body)
+
+    lines.extend(['            pass',
+                  '        except ArgumentException:',
+                  '            raise',
+                  '        except Exception:',
+                  '            log_hook_error(hook)',
+                  '            raise ArgumentException("Error in argument '
+                  'validation")'])
+    return lines
+
+
 def storm_to_spec(obj, **kwargs):
+    '''
+    Get the ArgumentList for a storm class.
+
+    The list is built once per class and keyword arguments and cached frozen,
+    callers get a copy of it (see L{ArgumentList.copy}) that compiles to the
+    validators of the cached list. The list is rebuilt if storm's class info
+    for L{obj} is replaced.
+
+    @param obj: Storm class to use.
+    @param **kwargs: Additional arguments passed to each L{Argument}.
+    @return: L{ArgumentList}
+    '''
+    try:
+        key = (obj, tuple(sorted(kwargs.iteritems())))
+        info, spec = __specs__[key]
+
+        if get_cls_info(obj) is info:
+            return spec.copy()
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable keyword arguments, don't cache.
+        return _storm_to_spec(obj, **kwargs)
+
+    spec = _storm_to_spec(obj, **kwargs)
+    spec.frozen = True
+    __specs__[key] = (get_cls_info(obj), spec)
+    return spec.copy()
+
+
+def reset_specs(obj=None):
+    '''
+    Drop cached storm class specs.
+
+    @keyword obj: Only drop the specs for this class.
+    '''
+    for key in __specs__.keys():
+        if obj is None or key[0] is obj:
+            del __specs__[key]
+
+
+def _storm_to_spec(obj, **kwargs):
     '''
     Create an ArgumentList object from a storm class
 
     @param obj: Storm class to use.
+    @param **kwargs: Additional arguments passed to each L{Argument}.
     '''
     type_map = {'Unicode': (str, unicode),
                 'Int': (int, long),
@@ -33,7 +33,6 @@ import bottle
 import traceback
 from storm.exceptions import DisconnectionError
 from woodstove.common import logger
-from woodstove.db import stormy
 from woodstove import exceptions, app
 
 
@@ -123,10 +122,12 @@ def exc_setup():
                          generic_handler(404, 'Not found'))
     register_exc_handler(exceptions.RequestException,
                          generic_handler(400))
+    register_exc_handler(exceptions.PreconditionException,
+                         generic_handler(412, 'Precondition Failed'))
+    register_exc_handler(exceptions.ConflictException, generic_handler(409))
     register_exc_handler(DisconnectionError,
                          generic_handler(500,
                                          'Internal Error',
-                                         'Database connection lost!',
-                                         lambda *_: stormy.Stormy().reset_timeouts()))
+                                         'Database connection lost!'))
     register_exc_handler(exceptions.InternalException,
                          generic_handler(500, 'Internal Error'))
@@ -28,15 +28,36 @@
 ''' CRUD App mixin '''
 
 
+import csv
 import json
 import inspect
+import traceback
+import cStringIO
 import bottle
 from woodstove import exceptions, plugin
+from woodstove.common import logger
 from woodstove.app import arguments
 from woodstove.db import stormy
 from woodstove.db import generic
 
 
+# Content types of the export formats.
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# Per item status and default message of errors in bulk requests.
+BULK_ERRORS = {
+    exceptions.ArgumentException: (400, None),
+    exceptions.RequestException: (400, None),
+    exceptions.AuthException: (401, 'Not Authorized'),
+    exceptions.NotFoundException: (404, 'Not found'),
+    exceptions.ConflictException: (409, None),
+    exceptions.PreconditionException: (412, None),
+}
+
+
 def crud_hook(hook):
     '''
     Setup a CRUDApp method as a hook in the crud_hooks dict.
@@ -66,6 +87,25 @@ class CRUD(object):
     @var crud_key_name:
     @var crud_hooks:
     @var crud_find_limit:
+    @var crud_find_totals: Default totals mode for find, 'exact',
+        'estimated' or 'none'.
+    @var crud_import_batch: Number of records committed at a time by
+        L{import_records}.
+    @var crud_export_batch: Number of rows fetched at a time by
+        L{export_records}.
+    @var crud_etag: Send row versions as ETags and honour If-Match on
+        update, patch and replace, see L{stormy.row_version}. The check is
+        only atomic for classes with a version column, see
+        L{stormy.version_guard}.
+    @var crud_read_etag: Only send row versions as ETags on reads, so
+        pollers get a 304. Finds are unchanged and If-Match is ignored.
+    @var crud_updated_name: Name of the column holding the UTC time of the
+        last change. It is sent as Last-Modified and used for conditional
+        reads and finds.
+    @var crud_fields_allowed: Fields that may be requested with the fields
+        query parameter when L{crud_encode} is overridden. Projected
+        records skip L{crud_encode}, so by default projection is refused
+        for classes that override it.
     @var crud_fn:
     @var crud_argfmt:
     '''
@@ -76,6 +116,13 @@ class CRUD(object):
     crud_key_name = None
     crud_hooks = None
     crud_find_limit = None
+    crud_find_totals = 'exact'
+    crud_import_batch = 1000
+    crud_export_batch = 1000
+    crud_etag = False
+    crud_read_etag = False
+    crud_updated_name = None
+    crud_fields_allowed = None
     crud_fn = None
     crud_argfmt = None
     _crud_fn = None
@@ -87,23 +134,37 @@ class CRUD(object):
         @param **kwargs:
         '''
         super(CRUD, self).__init__()
+        spec = arguments.storm_to_spec(self.crud_klass)
         self._crud_argfmt = {
-            'create': arguments.storm_to_spec(self.crud_klass),
-            'update': arguments.storm_to_spec(self.crud_klass),
-            'replace': arguments.storm_to_spec(self.crud_klass),
-            'find': arguments.storm_to_spec(self.crud_klass),
+            'create': spec,
+            'update': spec,
+            'patch': spec,
+            'replace': spec,
+            'find': spec,
         }
 
         if self.crud_argfmt:
             self._crud_argfmt.update(self.crud_argfmt)
 
+        for spec in self._crud_argfmt.itervalues():
+            spec.compile()
+
         self._crud_fn = {
             'create': generic.create,
             'read': generic.get,
+            'read_fields': generic.get_fields,
+            'read_version': generic.get_version,
             'update': generic.update,
+            'patch': generic.patch,
             'delete': generic.delete,
             'replace': generic.replace,
             'find': generic.find,
+            'find_version': generic.find_version,
+            'find_page': generic.find_page,
+            'export': generic.export,
+            'bulk_create': generic.bulk_create,
+            'bulk_update': generic.bulk_update,
+            'bulk_delete': generic.bulk_delete,
         }
 
         if self.crud_fn:
@@ -133,6 +194,467 @@ class CRUD(object):
         '''
         return stormy.storm_to_dict(obj)
 
+    def crud_encode_etag(self, obj):
+        '''
+        Encode an object with L{crud_encode} and add its ETag as the _etag
+        field.
+
+        @param obj: Storm object.
+        @return: Encoded object.
+        '''
+        data = self.crud_encode(obj)
+        data['_etag'] = self.crud_etag_value(obj)
+        return data
+
+    def crud_etag_value(self, obj):
+        '''
+        Get the ETag of an object.
+
+        @param obj: Storm object.
+        @return: Quoted row version.
+        '''
+        return '"%s"' % stormy.row_version(obj)
+
+    def crud_validators(self, obj):
+        '''
+        Get the ETag and the time of the last change of an object for
+        conditional requests. Classes with a version column and apps with
+        L{crud_etag} or L{crud_read_etag} set use the row version, see
+        L{crud_etag_value}, others a weak ETag of L{crud_updated_name}.
+
+        @param obj: Storm object.
+        @return: C{tuple} of the ETag and the last change, either is None if
+            not available.
+        '''
+        updated = None
+        version = None
+
+        if self.crud_updated_name:
+            updated = getattr(obj, self.crud_updated_name)
+
+        if (self.crud_etag or self.crud_read_etag or
+                stormy.version_column(self.crud_klass) is not None):
+            version = stormy.row_version(obj)
+
+        return self._crud_etag(version, updated), updated
+
+    def _crud_etag(self, version, updated):
+        '''
+        Pick the ETag for a row version and last change time.
+
+        @param version: Row version or None.
+        @param updated: C{datetime} of the last change or None.
+        @return: ETag or None.
+        '''
+        if version is not None:
+            return '"%s"' % version
+
+        if updated is not None and not self.crud_etag:
+            return 'W/"%s"' % updated.isoformat()
+
+    def _crud_read_not_modified(self, key):
+        '''
+        Check a conditional read against the version column and
+        L{crud_updated_name} of a record without loading the whole row.
+        Nothing is queried for unconditional reads or when the ETag is a
+        hash of the row.
+
+        @param key: Key of the record.
+        @return: True if the client's copy is current.
+        '''
+        headers = bottle.request.headers
+        version = stormy.version_column(self.crud_klass)
+
+        if 'If-None-Match' in headers:
+            if version is None and (self.crud_etag or self.crud_read_etag or
+                                    not self.crud_updated_name):
+                return False
+        elif 'If-Modified-Since' not in headers or not self.crud_updated_name:
+            return False
+
+        version, updated = self._crud_fn['read_version'](
+            self.crud_klass, key, self.crud_updated_name)
+        return self.not_modified(self._crud_etag(version, updated), updated)
+
+    def _crud_find_not_modified(self, where, counting=False):
+        '''
+        Set the validators of a find from the number of matching records and
+        their latest change, see L{generic.find_version}, and check them
+        against a conditional request before the find runs. The aggregate
+        only runs for conditional requests, or when the find counts the
+        records anyway since it gives the count too.
+
+        @param where: Validated where C{dict}.
+        @keyword counting: Will the find count the matching records?
+        @return: C{tuple} of True if the client's copy is current and the
+            number of matching records, None if it was not counted.
+        '''
+        headers = bottle.request.headers
+        conditional = ('If-None-Match' in headers or
+                       'If-Modified-Since' in headers)
+
+        if not self.crud_updated_name or not (conditional or counting):
+            return False, None
+
+        count, updated = self._crud_fn['find_version'](
+            self.crud_klass, self.crud_updated_name, where=where)
+        etag = 'W/"%d-%s"' % (count, updated.isoformat() if updated else '')
+        return self.not_modified(etag, updated), count
+
+    def crud_if_match(self):
+        '''
+        Get the row versions of the If-Match header. Weak ETags never match.
+
+        @return: C{tuple} of row versions, None if ETags are disabled or the
+            header is missing or *.
+        '''
+        header = bottle.request.headers.get('If-Match')
+
+        if not self.crud_etag or not header or header.strip() == '*':
+            return None
+
+        return tuple(tag.strip().strip('"') for tag in header.split(',')
+                     if not tag.strip().startswith('W/'))
+
+    def _crud_write(self, fn, *args):
+        '''
+        Call a write function from L{_crud_fn}, conditional on If-Match.
+
+        @param fn: Name of the function in L{_crud_fn}.
+        @param *args: Arguments for the function.
+        @return: Result of the function.
+        '''
+        if_match = self.crud_if_match()
+
+        if if_match is None:
+            return self._crud_fn[fn](self.crud_klass, *args)
+
+        return self._crud_fn[fn](self.crud_klass, *args, if_match=if_match)
+
+    def _crud_etag_response(self, obj):
+        '''
+        Set the ETag header for an object and build the response.
+
+        @param obj: Storm object.
+        @return: API response.
+        '''
+        if self.crud_etag:
+            self.wsgi_response().set_header('ETag', self.crud_etag_value(obj))
+
+        return self.response(self.crud_encode(obj))
+
+    def _crud_read_response(self, obj):
+        '''
+        Build the response for a read, empty if the client's copy of the
+        object is current.
+
+        @param obj: Storm object.
+        @return: API response.
+        '''
+        self.not_modified(*self.crud_validators(obj))
+        return self.response(self.crud_encode(obj))
+
+    def crud_fields(self):
+        '''
+        Get the fields requested with the fields query parameter. Projected
+        records are returned as they are, without L{crud_encode}, so when
+        it is overridden only L{crud_fields_allowed} can be requested.
+
+        @return: C{list} of field names or None for all fields.
+        @raise RequestException: If a field is not allowed.
+        '''
+        fields = bottle.request.query.get('fields')
+
+        if not fields:
+            return None
+
+        fields = [x.strip() for x in fields.split(',') if x.strip()]
+
+        if self.crud_encode.im_func is not CRUD.crud_encode.im_func:
+            allowed = self.crud_fields_allowed or ()
+            denied = [x for x in fields if x not in allowed]
+
+            if denied:
+                raise exceptions.RequestException(
+                    "Fields can not be selected: %s" % ', '.join(denied))
+
+        return fields
+
+    def crud_where(self):
+        '''
+        Get the filter from the where query parameter. Filter values may be
+        operator dicts so only the keys are checked against the find spec.
+
+        @return: Filter C{dict}.
+        @raise ArgumentException: If the filter is not valid.
+        '''
+        try:
+            where = json.loads(bottle.request.query.get('where', '{}'))
+        except ValueError:
+            raise exceptions.ArgumentException
+
+        self.validate(self._crud_argfmt['find'], where, chktype=False,
+                      func='find')
+        return where
+
+    def crud_key(self, key):
+        '''
+        Convert a record key to L{crud_key_type}.
+
+        @param key: Key from the request.
+        @raise RequestException: If the key is invalid.
+        '''
+        try:
+            return self.crud_key_type(key)
+        except (TypeError, ValueError):
+            raise exceptions.RequestException('Invalid key')
+
+    def crud_bulk_body(self):
+        '''
+        Get the list of items in a bulk request body.
+
+        @raise ArgumentException: If the body is not a list.
+        '''
+        body = bottle.request.json
+
+        if not isinstance(body, list):
+            raise exceptions.ArgumentException('Expected a list of items')
+
+        return body
+
+    def _crud_bulk(self, fn, items, prepare, status=200):
+        '''
+        Run a bulk function over the items of a bulk request. Items that fail
+        L{prepare} are reported and left out, the rest are passed to the bulk
+        function together.
+
+        @param fn: Name of the bulk function in L{_crud_fn}.
+        @param items: Items from the request body.
+        @param prepare: Function to validate and authorize one item, returns
+            the item to pass to the bulk function.
+        @keyword status: Status of the items that succeed.
+        @return: API response with the result of each item, in order.
+        '''
+        results = [None] * len(items)
+        indexes = []
+        args = []
+
+        for index, item in enumerate(items):
+            try:
+                args.append(prepare(item))
+                indexes.append(index)
+            except tuple(BULK_ERRORS) as execp:
+                results[index] = self._crud_bulk_error(execp, index=index)
+
+        if args:
+            rets = self._crud_fn[fn](self.crud_klass, args)
+
+            for index, ret in zip(indexes, rets):
+                if isinstance(ret, Exception):
+                    results[index] = self._crud_bulk_error(ret, index=index)
+                else:
+                    results[index] = {
+                        'index': index,
+                        'status': status,
+                        'data': self.crud_encode(ret),
+                    }
+
+        return self.response(results)
+
+    @classmethod
+    def _crud_bulk_error(cls, execp, **where):
+        '''
+        Format the result of a bulk item that failed.
+
+        @param execp: Exception raised for the item.
+        @keyword **where: Position of the item, index or line.
+        '''
+        code, message = BULK_ERRORS.get(execp.__class__, (500, None))
+        where.update({
+            'status': code,
+            'error': message if message else execp.message,
+        })
+        return where
+
+    @post('/_bulk')
+    def bulk_create(self, auth_callback=None):
+        '''
+        Create records from a list of records in the body. All records are
+        written in one transaction and the response lists the result of each.
+        '''
+        if not auth_callback:
+            auth_callback = self.crud_auth_fn
+
+        def prepare(item):
+            data = self.validate(self._crud_argfmt['create'], item,
+                                 func='create')
+            if self.crud_auth:
+                auth_callback(data=data)
+            return data
+
+        return self._crud_bulk('bulk_create', self.crud_bulk_body(), prepare,
+                               201)
+
+    @post('/_bulk/update')
+    def bulk_update(self, auth_callback=None):
+        '''
+        Update records from a list of records in the body, each record is
+        found by its L{crud_key_name} field. With L{crud_etag} set a record
+        with an _etag field is only updated if it still has that ETag.
+        '''
+        if not self.crud_key_name:
+            raise exceptions.RequestException('Bulk update not supported')
+
+        if not auth_callback:
+            auth_callback = self.crud_auth_fn
+
+        def prepare(item):
+            if not isinstance(item, dict) or self.crud_key_name not in item:
+                raise exceptions.ArgumentException('Missing key')
+            item = dict(item)
+            key = self.crud_key(item.pop(self.crud_key_name))
+            etag = item.pop('_etag', None) if self.crud_etag else None
+            data = self.validate(self._crud_argfmt['update'], item,
+                                 func='update')
+            if self.crud_auth:
+                auth_callback(key, data)
+            if not isinstance(etag, basestring):
+                return key, data
+            # Weak ETags never match, like in crud_if_match.
+            if_match = () if etag.startswith('W/') else (etag.strip('"'),)
+            return key, data, if_match
+
+        return self._crud_bulk('bulk_update', self.crud_bulk_body(), prepare)
+
+    @post('/_bulk/delete')
+    def bulk_delete(self, auth_callback=None):
+        ''' Delete records from a list of keys in the body. '''
+        if not auth_callback:
+            auth_callback = self.crud_auth_fn
+
+        def prepare(item):
+            key = self.crud_key(item)
+            if self.crud_auth:
+                auth_callback(key)
+            return key
+
+        return self._crud_bulk('bulk_delete', self.crud_bulk_body(), prepare)
+
+    @post('/_import')
+    def import_records(self, auth_callback=None):
+        '''
+        Create records from newline delimited JSON in the body.
+
+        The body is read as it arrives and records are committed every
+        L{crud_import_batch} lines. The response is newline delimited JSON
+        too: a progress line after every commit, an error line for every line
+        that could not be imported and a summary line at the end. A line
+        longer than L{body_lines} allows stops the import with an error line.
+        '''
+        if not auth_callback:
+            auth_callback = self.crud_auth_fn
+
+        bottle.response.content_type = 'application/x-ndjson'
+        return self._crud_import(self.body_lines(), auth_callback)
+
+    def _crud_import(self, lines, auth_callback):
+        '''
+        Generator behind L{import_records}.
+
+        @param lines: Iterator of body lines.
+        @param auth_callback: Auth function called for each record.
+        '''
+        batch = []
+        created = 0
+        failed = 0
+        number = 0
+        lines = enumerate(lines, 1)
+
+        while True:
+            try:
+                number, line = next(lines)
+            except StopIteration:
+                break
+            except exceptions.RequestException as execp:
+                yield json.dumps(self._crud_bulk_error(
+                    execp, line=number + 1)) + '\n'
+                return
+
+            if not line.strip():
+                continue
+
+            try:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    raise exceptions.ArgumentException('Invalid JSON')
+
+                data = self.validate(self._crud_argfmt['create'], data,
+                                     func='create')
+                if self.crud_auth:
+                    auth_callback(data=data)
+            except tuple(BULK_ERRORS) as execp:
+                failed += 1
+                yield json.dumps(self._crud_bulk_error(execp,
+                                                       line=number)) + '\n'
+                continue
+
+            batch.append((number, data))
+
+            if len(batch) < self.crud_import_batch:
+                continue
+
+            errors = self._crud_import_batch(batch)
+            batch = []
+
+            if errors is None:
+                yield json.dumps({'line': number, 'status': 500,
+                                  'error': 'Internal Error'}) + '\n'
+                return
+
+            for error in errors:
+                yield json.dumps(error) + '\n'
+
+            created += self.crud_import_batch - len(errors)
+            failed += len(errors)
+            yield json.dumps({'line': number, 'created': created}) + '\n'
+
+        if batch:
+            errors = self._crud_import_batch(batch)
+
+            if errors is None:
+                yield json.dumps({'line': number, 'status': 500,
+                                  'error': 'Internal Error'}) + '\n'
+                return
+
+            for error in errors:
+                yield json.dumps(error) + '\n'
+
+            created += len(batch) - len(errors)
+            failed += len(errors)
+
+        yield json.dumps({'lines': number, 'created': created,
+                          'failed': failed}) + '\n'
+
+    def _crud_import_batch(self, batch):
+        '''
+        Create and commit a batch of imported records.
+
+        @param batch: C{list} of (line number, validated record) tuples.
+        @return: C{list} of error lines for the records that could not be
+            created, None if the batch failed.
+        '''
+        try:
+            rets = self._crud_fn['bulk_create'](self.crud_klass,
+                                                [data for _, data in batch])
+        except Exception:
+            logger.Logger(__name__).error(traceback.format_exc())
+            return None
+
+        return [self._crud_bulk_error(ret, line=number)
+                for (number, _), ret in zip(batch, rets)
+                if isinstance(ret, Exception)]
+
     @post('/')
     def create(self, auth_callback=None):
         ''' '''
@@ -156,8 +678,14 @@ class CRUD(object):
             if not auth_callback:
                 auth_callback = self.crud_read_auth_fn
             auth_callback(key)
-        return self.response(self.crud_encode(self._crud_fn['read'](
-            self.crud_klass, key)))
+        fields = self.crud_fields()
+        if fields:
+            return self.response(self._crud_fn['read_fields'](
+                self.crud_klass, key, fields))
+        if self._crud_read_not_modified(key):
+            return ''
+        return self._crud_read_response(self._crud_fn['read'](
+            self.crud_klass, key))
 
     @post('/:key')
     def update(self, key, auth_callback=None):
@@ -171,8 +699,23 @@ class CRUD(object):
             if not auth_callback:
                 auth_callback = self.crud_auth_fn
             auth_callback(key, data)
-        return self.response(self.crud_encode(self._crud_fn['update'](
-            self.crud_klass, key, data)))
+        return self._crud_etag_response(self._crud_write('update', key, data))
+
+    @patch('/:key')
+    def patch(self, key, auth_callback=None):
+        ''' Update only the fields passed, skip the write if none changed '''
+        # Argument hooks limited to updates apply to patches too.
+        data = self.validate(self._crud_argfmt['patch'], func='update',
+                             partial=True)
+        try:
+            key = self.crud_key_type(key)
+        except ValueError:
+            raise exceptions.RequestException('Invalid key')
+        if self.crud_auth:
+            if not auth_callback:
+                auth_callback = self.crud_auth_fn
+            auth_callback(key, data)
+        return self._crud_etag_response(self._crud_write('patch', key, data))
 
     @put('/:key')
     def replace(self, key, auth_callback=None):
@@ -191,6 +734,9 @@ class CRUD(object):
             auth_callback(key)
         if not self.crud_key_name:
             raise
+        if self.crud_if_match() is not None:
+            return self._crud_etag_response(self._crud_write(
+                'replace', self.crud_key_name, key, data))
         try:
             ret = self._crud_fn['replace'](self.crud_klass, self.crud_key_name,
                                            key, data)
@@ -216,25 +762,177 @@ class CRUD(object):
 
     @get('/')
     def find(self, auth_callback=None):
-        ''' '''
+        '''
+        Find records. Passing the cursor query parameter switches from offset
+        to keyset pagination: an empty cursor returns the first page and the
+        response has a next_cursor to pass for the following page.
+
+        The totals query parameter picks how the total is computed, see
+        L{stormy.Query.total}. With 'none' the total is the number of records
+        returned.
+
+        The fields query parameter is a comma separated list of the columns
+        to return, see L{crud_fields}. With L{crud_etag} set full records
+        carry their ETag in the _etag field.
+
+        With L{crud_updated_name} set the number of matching records and
+        their latest change are the validators of the response, checked
+        against If-None-Match and If-Modified-Since before the find runs.
+        They are only sent for conditional requests and exact totals, the
+        total is then taken from the same query.
+        '''
         if self.crud_read_auth:
             if not auth_callback:
                 auth_callback = self.crud_read_auth_fn
 
             auth_callback()
 
+        where = self.crud_where()
+
         try:
             limit = bottle.request.query.get('limit', self.crud_find_limit)
             args = dict({
-                'where': json.loads(bottle.request.query.get('where', '{}')),
+                'where': where,
                 'offset': int(bottle.request.query.get('offset', 0)),
                 'limit': limit if limit is None else int(limit),
                 'sort': bottle.request.query.get('sort', None),
+                'totals': bottle.request.query.get('totals',
+                                                   self.crud_find_totals),
+                'fields': self.crud_fields(),
             })
         except ValueError:
             raise exceptions.ArgumentException
 
-        self.validate(self._crud_argfmt['find'], args['where'], False)
-        ret = list(self._crud_fn['find'](self.crud_klass, **args))
-        ret[0] = [self.crud_encode(x) for x in ret[0]]
-        return self.response(ret[0], total=ret[1])
+        current, count = self._crud_find_not_modified(
+            where, args['totals'] == 'exact' and
+            'cursor' not in bottle.request.query)
+
+        if current:
+            return ''
+
+        if count is not None:
+            args['totals'] = 'none'
+
+        encode = None
+        if not args['fields']:
+            encode = (self.crud_encode_etag if self.crud_etag
+                      else self.crud_encode)
+
+        if 'cursor' in bottle.request.query:
+            results, next_cursor = self._crud_fn['find_page'](
+                self.crud_klass, where=args['where'], limit=args['limit'],
+                sort=args['sort'], cursor=bottle.request.query.get('cursor'),
+                fields=args['fields'])
+            if encode:
+                results = [encode(x) for x in results]
+            return self.response(results, next_cursor=next_cursor)
+
+        results, total = self._crud_fn['find'](self.crud_klass, **args)
+
+        if count is not None:
+            total = count
+
+        return self.stream_response(results, total=total, encode=encode)
+
+    @get('/_export')
+    def export_records(self, auth_callback=None):
+        '''
+        Export all records matching the where query parameter with a single
+        query. The format query parameter is 'ndjson' (the default) or 'csv'
+        and the sort and fields query parameters work like in L{find}.
+        '''
+        if self.crud_read_auth:
+            if not auth_callback:
+                auth_callback = self.crud_read_auth_fn
+
+            auth_callback()
+
+        fmt = bottle.request.query.get('format', 'ndjson')
+
+        if fmt not in EXPORT_FORMATS:
+            raise exceptions.RequestException("Invalid format: %s" % fmt)
+
+        where = self.crud_where()
+        fields = self.crud_fields()
+        records = self._crud_fn['export'](
+            self.crud_klass, where=where, sort=bottle.request.query.get('sort'),
+            fields=fields, batch_size=self.crud_export_batch)
+
+        if not fields:
+            records = (self.crud_encode(x) for x in records)
+
+        bottle.response.content_type = EXPORT_FORMATS[fmt]
+
+        if fmt == 'csv':
+            if not fields:
+                fields = [name for name, _ in stormy.serializer(
+                    self.crud_klass)]
+
+            return self._crud_export_csv(records, fields)
+
+        return self._crud_export_ndjson(records)
+
+    @classmethod
+    def _crud_export_ndjson(cls, records, chunk_size=100):
+        '''
+        Encode exported records as newline delimited JSON.
+
+        @param records: Iterator of record dicts.
+        @keyword chunk_size: Number of records per chunk.
+        '''
+        chunk = []
+
+        for record in records:
+            chunk.append(json.dumps(record) + '\n')
+
+            if len(chunk) >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+
+        if chunk:
+            yield ''.join(chunk)
+
+    @classmethod
+    def _crud_export_csv(cls, records, columns, chunk_size=100):
+        '''
+        Encode exported records as CSV with a header row.
+
+        @param records: Iterator of record dicts.
+        @param columns: Names of the columns to write.
+        @keyword chunk_size: Number of records per chunk.
+        '''
+        buf = cStringIO.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        count = 0
+
+        for record in records:
+            writer.writerow([_csv_value(record.get(x)) for x in columns])
+            count += 1
+
+            if count >= chunk_size:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+                count = 0
+
+        yield buf.getvalue()
+
+
+def _csv_value(value):
+    '''
+    Convert a record value for the csv module.
+
+    @param value: Value from a record dict.
+    @return: C{str} to write.
+    '''
+    if value is None:
+        return ''
+
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value)
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
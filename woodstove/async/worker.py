@@ -35,7 +35,7 @@ import json
 import rq
 import rq.timeouts
 import redis
-from woodstove.db import stormy
+from woodstove.db import stormy, profiler
 from woodstove.async import job
 from woodstove.common import logger, config, context
 from woodstove import exceptions, server, plugin
@@ -80,7 +80,7 @@ def worker_exception_handler(job, exc_type, exc_value, trace):
     except Exception:
         logger.Logger(__name__).error(traceback.format_exc())
     finally:
-        stormy.Stormy().close()
+        stormy.Stormy().release()
 
 
 def start_worker():
@@ -130,6 +130,9 @@ def run_job(uuid):
         job.running()
         logger.Logger(__name__).debug("Calling %s(*%r, **%r)", job.func,
                                       job.args, job.kwargs)
-        func(*json.loads(job.args), job=job, **json.loads(job.kwargs))
+
+        with profiler.Profile('%s.%s' % (job.module, job.func)):
+            func(*json.loads(job.args), job=job, **json.loads(job.kwargs))
+
         job.success()
-        stormy.Stormy().close()
+        stormy.Stormy().release()
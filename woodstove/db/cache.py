@@ -0,0 +1,429 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+'''
+Opt-in identity cache for L{woodstove.db.generic.get}.
+
+Storm only caches objects per store, so objects are read again by every
+request. Classes registered here keep the database values of their rows,
+keyed by primary key, either in process or in redis when shared. Cached rows
+are loaded into the store of the caller like rows fetched from the database.
+Only rows read from the primary database outside of a write transaction are
+cached, never replica reads. The cache is invalidated by the generic update,
+delete, replace and create hooks, other writes are only picked up when the
+entry expires.
+'''
+
+import time
+import json
+import base64
+import decimal
+import datetime
+import threading
+import collections
+import redis
+from storm.database import Result
+from storm.info import get_cls_info, get_obj_info
+from woodstove import plugin
+from woodstove.common import config
+
+
+__caches__ = dict()
+
+# generic hooks that invalidate the cached row of the object they are
+# called with.
+INVALIDATE_HOOKS = ('update.postcommit', 'delete.postcommit',
+                    'replace.preremove', 'create.postcommit')
+
+
+def register(cls, ttl=60, size=1000, shared=False):
+    '''
+    Enable the identity cache for a storm class.
+
+    @param cls: Storm class.
+    @keyword ttl: Seconds an entry is kept.
+    @keyword size: Maximum number of entries kept in process, the least
+        recently used entries are dropped first.
+    @keyword shared: Keep the entries in redis, shared by all processes,
+        instead of in process.
+    @return: The L{IdentityCache} for L{cls}.
+    '''
+    unregister(cls)
+
+    if shared:
+        backend = SharedBackend(get_cls_info(cls).table.name, ttl)
+    else:
+        backend = LocalBackend(ttl, size)
+
+    cache = __caches__[cls] = IdentityCache(cls, backend)
+
+    for name in INVALIDATE_HOOKS:
+        plugin.register_hook(cls, name, cache.invalidate_object)
+
+    return cache
+
+
+def unregister(cls):
+    '''
+    Disable the identity cache for a storm class.
+
+    @param cls: Storm class.
+    '''
+    cache = __caches__.pop(cls, None)
+
+    if cache is None:
+        return
+
+    for name in INVALIDATE_HOOKS:
+        plugin.remove_hook(cls, name, cache.invalidate_object)
+
+    cache.clear()
+
+
+def cached(ttl=60, size=1000, shared=False):
+    '''
+    Class decorator version of L{register}.
+
+    >>> @cached(ttl=300)
+    ... class Setting(Storm):
+    ...     __storm_table__ = 'settings'
+    '''
+    def decorator(cls):
+        '''
+        Register L{cls} and return it.
+
+        @param cls: Storm class.
+        '''
+        register(cls, ttl, size, shared)
+        return cls
+
+    return decorator
+
+
+def get_cache(cls):
+    '''
+    Get the identity cache of a class.
+
+    @param cls: Storm class.
+    @return: L{IdentityCache} or None if L{cls} is not cached.
+    '''
+    return __caches__.get(cls)
+
+
+def stats():
+    '''
+    Get the hit and miss counters of all caches.
+
+    @return: C{dict} of table name to counters.
+    '''
+    return dict((get_cls_info(cls).table.name, dict(cache.stats))
+                for cls, cache in __caches__.items())
+
+
+class IdentityCache(object):
+    '''
+    Primary key to row cache of one storm class.
+
+    @ivar cls: Storm class.
+    @ivar backend: L{LocalBackend} or L{SharedBackend}.
+    @ivar stats: C{dict} of counters: hits, misses and invalidations.
+    '''
+
+    def __init__(self, cls, backend):
+        '''
+        @param cls: Storm class.
+        @param backend: Storage for the entries.
+        '''
+        self.cls = cls
+        self.backend = backend
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def key(self, key):
+        '''
+        Normalize a primary key like storm does in Store.get.
+
+        @param key: Primary key value, a C{tuple} for composed keys.
+        @return: C{tuple} of database values.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        primary = get_cls_info(self.cls).primary_key
+        return tuple(column.variable_factory(value=value).get(to_db=True)
+                     for column, value in zip(primary, key))
+
+    def get(self, store, key):
+        '''
+        Get a cached object.
+
+        @param store: Store to load the object into, or a Stormy instance.
+        @param key: Primary key value.
+        @return: Instance of L{cls} or None if it is not cached.
+        '''
+        values = self.backend.get(self.key(key))
+
+        if values is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        store = getattr(store, 'store', store)
+        return store._load_object(get_cls_info(self.cls), Result, values)
+
+    def put(self, obj):
+        '''
+        Cache the row of a loaded object. Objects with columns that are not
+        loaded are not cached.
+
+        @param obj: Instance of L{cls}.
+        '''
+        obj_info = get_obj_info(obj)
+        cls_info = obj_info.cls_info
+        variables = [obj_info.variables[column]
+                     for column in cls_info.columns]
+
+        if not all(variable.is_defined() for variable in variables):
+            return
+
+        values = tuple(variable.get(to_db=True) for variable in variables)
+        key = tuple(obj_info.variables[column].get(to_db=True)
+                    for column in cls_info.primary_key)
+        self.backend.set(key, values)
+
+    def invalidate(self, key):
+        '''
+        Drop the entry of a primary key.
+
+        @param key: Primary key value.
+        '''
+        self.stats['invalidations'] += 1
+        self.backend.delete(self.key(key))
+
+    def invalidate_object(self, obj, *args, **kwargs):
+        '''
+        Hook to drop the entry of an object.
+
+        @param obj: Instance of L{cls}.
+        '''
+        obj_info = get_obj_info(obj)
+        self.stats['invalidations'] += 1
+        self.backend.delete(tuple(obj_info.variables[column].get(to_db=True)
+                                  for column in obj_info.cls_info.primary_key))
+
+    def clear(self):
+        ''' Drop all entries '''
+        self.backend.clear()
+
+
+class LocalBackend(object):
+    '''
+    In process LRU storage with expiry.
+    '''
+
+    def __init__(self, ttl, size):
+        '''
+        @param ttl: Seconds an entry is kept.
+        @param size: Maximum number of entries.
+        '''
+        self.ttl = ttl
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        @param key: Normalized primary key.
+        @return: Cached values or None.
+        '''
+        with self.lock:
+            try:
+                expires, values = self.entries.pop(key)
+            except KeyError:
+                return None
+
+            if expires <= time.time():
+                return None
+
+            self.entries[key] = (expires, values)
+            return values
+
+    def set(self, key, values):
+        '''
+        @param key: Normalized primary key.
+        @param values: Database values of the row.
+        '''
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, values)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        '''
+        @param key: Normalized primary key.
+        '''
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        ''' Drop all entries '''
+        with self.lock:
+            self.entries.clear()
+
+
+def _encode_value(value):
+    '''
+    Make a database value JSON serializable. Values that JSON can not tell
+    apart from others are tagged with their type.
+
+    @param value: Database value of a column.
+    @return: JSON serializable value.
+    @raise TypeError: If the type of L{value} is not supported.
+    '''
+    if value is None or isinstance(value, (bool, int, long, float, unicode)):
+        return value
+
+    if isinstance(value, (str, buffer)):
+        return ['bytes', base64.b64encode(value)]
+
+    if isinstance(value, decimal.Decimal):
+        return ['decimal', str(value)]
+
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            raise TypeError("Can not cache %r" % value)
+
+        return ['datetime', [value.year, value.month, value.day, value.hour,
+                             value.minute, value.second, value.microsecond]]
+
+    if isinstance(value, datetime.date):
+        return ['date', [value.year, value.month, value.day]]
+
+    if isinstance(value, datetime.time) and value.tzinfo is None:
+        return ['time', [value.hour, value.minute, value.second,
+                         value.microsecond]]
+
+    if isinstance(value, datetime.timedelta):
+        return ['timedelta', [value.days, value.seconds, value.microseconds]]
+
+    raise TypeError("Can not cache %r" % type(value))
+
+
+def _decode_value(value):
+    '''
+    Reverse L{_encode_value}.
+
+    @param value: Value decoded from JSON.
+    @return: Database value.
+    '''
+    if not isinstance(value, list):
+        return value
+
+    kind, data = value
+
+    if kind == 'bytes':
+        return base64.b64decode(data)
+
+    if kind == 'decimal':
+        return decimal.Decimal(data)
+
+    if kind == 'datetime':
+        return datetime.datetime(*data)
+
+    if kind == 'date':
+        return datetime.date(*data)
+
+    if kind == 'time':
+        return datetime.time(*data)
+
+    return datetime.timedelta(*data)
+
+
+class SharedBackend(object):
+    '''
+    Redis storage shared by every process, using the woodstove.cache redis
+    settings or the woodstove.queue ones. Rows are stored as JSON, rows with
+    values L{_encode_value} does not support are not cached.
+    '''
+
+    def __init__(self, name, ttl):
+        '''
+        @param name: Name of the cache, used in the redis keys.
+        @param ttl: Seconds an entry is kept.
+        '''
+        self.prefix = 'woodstove:cache:%s:' % name
+        self.ttl = ttl
+        self._redis = None
+
+    @property
+    def redis(self):
+        ''' Redis connection, created on first use '''
+        if self._redis is None:
+            conf = config.Config().woodstove
+            opts = conf.cache.dict if 'cache' in conf.dict else conf.queue.dict
+            self._redis = redis.Redis(opts.get('host', 'localhost'),
+                                      opts.get('port', 6379))
+
+        return self._redis
+
+    def get(self, key):
+        '''
+        @param key: Normalized primary key.
+        @return: Cached values or None.
+        '''
+        data = self.redis.get(self.prefix + repr(key))
+
+        if data is None:
+            return None
+
+        return tuple(_decode_value(value) for value in json.loads(data))
+
+    def set(self, key, values):
+        '''
+        @param key: Normalized primary key.
+        @param values: Database values of the row.
+        '''
+        try:
+            data = json.dumps([_encode_value(value) for value in values])
+        except TypeError:
+            return
+
+        self.redis.set(self.prefix + repr(key), data, ex=self.ttl)
+
+    def delete(self, key):
+        '''
+        @param key: Normalized primary key.
+        '''
+        self.redis.delete(self.prefix + repr(key))
+
+    def clear(self):
+        ''' Drop all entries '''
+        keys = self.redis.keys(self.prefix + '*')
+
+        if keys:
+            self.redis.delete(*keys)
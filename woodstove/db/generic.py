@@ -28,14 +28,20 @@
 ''' Generic database utilities '''
 
 
-from storm.expr import Desc
-from storm.exceptions import NotOneError
-from woodstove.db import stormy
+from storm.expr import Desc, And
+from storm.exceptions import NotOneError, IntegrityError
+from storm.info import get_cls_info
+from woodstove.db import stormy, cache
 from woodstove import exceptions, plugin
 
 
+# Number of rows written or loaded per statement by the bulk functions.
+BULK_BATCH_SIZE = 500
+
+
+@stormy.idempotent
 def find(stype, where=None, offset=0, limit=None, sort=None,
-                 distinct=False):
+                 distinct=False, totals='exact', fields=None):
     '''
     @param stype:
     @keyword where:
@@ -43,10 +49,62 @@ def find(stype, where=None, offset=0, limit=None, sort=None,
     @keyword limit:
     @keyword sort:
     @keyword distinct:
+    @keyword totals: 'exact', 'estimated' or 'none', see L{stormy.Query.total}.
+    @keyword fields: Only select these columns and return dicts.
+    @return: C{tuple} of the objects and the total.
+    '''
+    query = _find_query(stype, where, offset, limit, sort, fields)
+    return query.execute(totals)
+
+
+def export(stype, where=None, sort=None, fields=None, batch_size=1000):
+    '''
+    Iterate over every object matching L{where} with one query, fetching
+    L{batch_size} rows at a time. The find hooks are called like in L{find}.
+
+    @param stype:
+    @keyword where:
+    @keyword sort:
+    @keyword fields: Only select these columns and return dicts.
+    @keyword batch_size: Number of rows fetched at a time.
+    @return: Iterator of objects, or dicts if L{fields} is given.
+    '''
+    return _find_query(stype, where, sort=sort, fields=fields).iterate(
+        batch_size)
+
+
+@stormy.idempotent
+def find_version(stype, updated_name, where=None):
+    '''
+    Get the number of objects matching L{where} and the latest value of
+    their L{updated_name} column, without loading them. This changes with
+    the results of L{find} and is cheap enough to check before running it.
+    The find hooks are called like in L{find}.
+
+    @param stype:
+    @param updated_name: Name of the column holding the time of the last
+        change.
+    @keyword where:
+    @return: C{tuple} of the number of objects and the latest change.
+    '''
+    return _find_query(stype, where).version(getattr(stype, updated_name))
+
+
+def _find_query(stype, where=None, offset=0, limit=None, sort=None,
+                fields=None):
+    '''
+    Build the query for L{find} and L{export}, calling the find hooks.
+
+    @return: L{stormy.Query}
     '''
     hook_storage = dict()
     sort_desc = False
     query = stormy.Query(stype)
+    query.readonly = True
+
+    if fields:
+        query.project(fields)
+
     query.offset = offset
     query.limit = limit
     plugin.call_hooks(stype, 'find.using', query, storage=hook_storage)
@@ -64,14 +122,87 @@ def find(stype, where=None, offset=0, limit=None, sort=None,
         except AttributeError:
             pass
 
+    if where:
+        query.filter(where)
+
+    plugin.call_hooks(stype, 'find.where', where, query, storage=hook_storage)
+    plugin.call_hooks(stype, 'find.sort', sort, query, storage=hook_storage)
+    return query
+
+
+@stormy.idempotent
+def find_page(stype, where=None, cursor=None, limit=None, sort=None,
+              fields=None):
+    '''
+    Find a page of objects using keyset pagination.
+
+    @param stype:
+    @keyword where:
+    @keyword cursor: Cursor returned for the previous page, None or an empty
+        string for the first page.
+    @keyword limit: Maximum number of objects on the page.
+    @keyword sort: Column to sort on, prefix with '-' for descending order.
+        Objects are sorted on the primary key after the sort column.
+    @keyword fields: Only select these columns and return dicts.
+    @return: C{tuple} of the list of objects on the page and the cursor for
+        the next page, or None if this is the last page.
+    @raise RequestException: If the cursor is invalid.
+    '''
+    hook_storage = dict()
+    desc = False
+    query = stormy.Query(stype)
+    query.readonly = True
+    query.offset = 0
+    plugin.call_hooks(stype, 'find.using', query, storage=hook_storage)
+
+    if sort:
+        if sort.startswith('-'):
+            sort = sort[1:]
+            desc = True
+
+        if not hasattr(stype, sort):
+            sort = None
+
+    keyset = stormy.Keyset(stype, sort or None, desc)
+    query.order = keyset.columns
+    query.desc = desc
+
+    if fields:
+        # The sort key is selected after the fields for the cursor.
+        query.project(fields)
+        query.columns += keyset.columns
+
     if where:
         query.where = stormy.gen_expr(stype, where)
 
     plugin.call_hooks(stype, 'find.where', where, query, storage=hook_storage)
     plugin.call_hooks(stype, 'find.sort', sort, query, storage=hook_storage)
-    return query.execute()
 
+    if cursor:
+        after = keyset.where(keyset.decode(cursor))
+        query.where = And(query.where, after) if query.where else after
 
+    if limit is None:
+        objs = list(query.results)
+        last = None
+    else:
+        objs = list(query.results[:limit + 1])
+        last = objs[limit - 1] if len(objs) > limit else None
+        objs = objs[:limit]
+
+    if query.plan is None:
+        cursor = keyset.encode(last) if last is not None else None
+        return (objs, cursor)
+
+    cursor = None
+
+    if last is not None:
+        cursor = keyset.encode_values(last[len(query.plan):])
+
+    return ([stormy.row_to_dict(row, query.plan) for row in objs], cursor)
+
+
+@stormy.idempotent
 def find_one(stype, expr=None, **kwargs):
     '''
     @param stype:
@@ -121,9 +252,14 @@ def create(stype, data):
     return new
 
 
+@stormy.idempotent
 def get(stype, key):
     '''
-    Get an object from db
+    Get an object from db. The object may come from a read replica or the
+    identity cache of L{stype} (see L{cache.register}) so it should not be
+    changed. The cache is only filled with rows read from the primary
+    outside of a write transaction, so it never holds stale replica rows or
+    uncommitted changes.
     
     @param stype:
     @param key:
@@ -131,9 +267,21 @@ def get(stype, key):
     @return: Instance of L{stype} with key L{key}.
     '''
     hook_storage = dict()
-    store = stormy.Stormy()
+    primary = stormy.Stormy()
+    store = primary.reader(stype)
     plugin.call_hooks(stype, 'get.preget', key, storage=hook_storage)
-    obj = store.get(stype, key)
+    identity = cache.get_cache(stype)
+    obj = None
+
+    if identity is not None:
+        obj = identity.get(store, key)
+
+    if obj is None:
+        obj = store.get(stype, key)
+
+        if (obj is not None and identity is not None and store is primary
+                and primary.primary() and not primary.writing()):
+            identity.put(obj)
 
     if not obj:
         plugin.call_hooks(stype, 'get.notfound', key, storage=hook_storage)
@@ -143,14 +291,92 @@ def get(stype, key):
     return obj
 
 
-def update(stype, key, data):
+@stormy.idempotent
+def get_fields(stype, key, fields):
+    '''
+    Get some of the columns of an object from db without loading the whole
+    row. The get.preget and get.notfound hooks are called, get.postget is
+    not since there is no object.
+
+    @param stype:
+    @param key: Primary key value, a C{tuple} for composed keys.
+    @param fields: Column names to select.
+    @raises NotfoundException: If requested object does not exist.
+    @raises RequestException: If a field is unknown.
+    @return: C{dict} of the selected fields.
+    '''
+    hook_storage = dict()
+    plan = stormy.projection(stype, fields)
+    columns = tuple(getattr(stype, name) for name, _ in plan)
+    primary = get_cls_info(stype).primary_key
+
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    plugin.call_hooks(stype, 'get.preget', key, storage=hook_storage)
+    store = stormy.Stormy().reader(stype)
+    row = store.find(columns, And(*[column == value for column, value
+                                    in zip(primary, key)])).one()
+
+    if row is None:
+        plugin.call_hooks(stype, 'get.notfound', key, storage=hook_storage)
+        raise exceptions.NotFoundException
+
+    return stormy.row_to_dict(row, plan)
+
+
+@stormy.idempotent
+def get_version(stype, key, updated_name=None):
+    '''
+    Get the version column and the L{updated_name} column of an object
+    without loading the whole row, to tell if it changed. The get.preget and
+    get.notfound hooks are called like in L{get_fields}.
+
+    @param stype:
+    @param key: Primary key value, a C{tuple} for composed keys.
+    @keyword updated_name: Name of the column holding the time of the last
+        change.
+    @raises NotfoundException: If requested object does not exist.
+    @return: C{tuple} of the row version, see L{stormy.row_version}, and the
+        last change. Each is None if the class does not have the column.
+    '''
+    hook_storage = dict()
+    version = stormy.version_column(stype)
+    updated = getattr(stype, updated_name) if updated_name else None
+    columns = tuple(x for x in (version, updated) if x is not None)
+    primary = get_cls_info(stype).primary_key
+
+    if not columns:
+        return None, None
+
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    plugin.call_hooks(stype, 'get.preget', key, storage=hook_storage)
+    store = stormy.Stormy().reader(stype)
+    row = store.find(columns, And(*[column == value for column, value
+                                    in zip(primary, key)])).one()
+
+    if row is None:
+        plugin.call_hooks(stype, 'get.notfound', key, storage=hook_storage)
+        raise exceptions.NotFoundException
+
+    row = list(row)
+    return (str(row.pop(0)) if version is not None else None,
+            row.pop(0) if updated is not None else None)
+
+
+def update(stype, key, data, if_match=None):
     '''
     Update an object of stype
 
     @param stype:
     @param key: 
     @param data: C{dict} of data to update object with.
+    @keyword if_match: C{tuple} of row versions, see L{stormy.row_version}.
+        If given the object is only updated if it still has one of them.
     @raises NotfoundException: If requested object does not exist.
+    @raises PreconditionException: If the object does not match L{if_match}.
     @return: Instance of L{stype} that was updated.
     '''
     hook_storage = dict()
@@ -161,10 +387,87 @@ def update(stype, key, data):
         plugin.call_hooks(stype, 'update.notfound', key, storage=hook_storage)
         raise exceptions.NotFoundException
 
+    return _update(store, stype, obj, data, hook_storage, if_match)
+
+
+def patch(stype, key, data, if_match=None):
+    '''
+    Update only the fields of an object that changed. Nothing is written and
+    no update hooks are called if every value in L{data} is already set.
+
+    @param stype:
+    @param key:
+    @param data: C{dict} of fields to update.
+    @keyword if_match: C{tuple} of row versions, see L{update}.
+    @raises NotfoundException: If requested object does not exist.
+    @raises PreconditionException: If the object does not match L{if_match}.
+    @return: Instance of L{stype}.
+    '''
+    hook_storage = dict()
+    store = stormy.Stormy()
+    obj = store.get(stype, key)
+
+    if not obj:
+        plugin.call_hooks(stype, 'update.notfound', key, storage=hook_storage)
+        raise exceptions.NotFoundException
+
+    if if_match is not None:
+        _match(obj, if_match)
+
+    data = stormy.changes(obj, data)
+
+    if not data:
+        return obj
+
+    return _update(store, stype, obj, data, hook_storage, if_match)
+
+
+def _match(obj, if_match):
+    '''
+    Check that an object has one of the row versions in L{if_match}.
+
+    @param obj: Storm object, None if it does not exist.
+    @param if_match: C{tuple} of row versions.
+    @raises PreconditionException: If it does not match.
+    '''
+    if obj is None or stormy.row_version(obj) not in if_match:
+        raise exceptions.PreconditionException('Object has been changed')
+
+
+def _update(store, stype, obj, data, hook_storage, if_match=None):
+    '''
+    Set L{data} on L{obj} and commit it, calling the update hooks. With
+    L{if_match} and a version column the changes are written by an UPDATE
+    that only matches the row if nobody changed it since it was loaded, see
+    L{stormy.version_guard}.
+
+    @param store: L{stormy.Stormy} instance.
+    @param stype:
+    @param obj: Instance of L{stype} to update.
+    @param data: C{dict} of data to update object with.
+    @param hook_storage: C{dict} shared by the hooks.
+    @keyword if_match: C{tuple} of row versions, see L{update}.
+    @return: L{obj}
+    '''
+    guard = None
+
+    if if_match is not None:
+        _match(obj, if_match)
+        guard = stormy.version_guard(obj)
+
     plugin.call_hooks(stype, 'update.preset', obj, data, storage=hook_storage)
 
     if hook_storage.get('do_set', True) is not False:
-        stormy.dict_set(obj, data)
+        store.mark_written(stype)
+
+        if guard is None:
+            stormy.dict_set(obj, data)
+            stormy.bump_version(obj)
+        elif not stormy.update_if(store, obj, dict(
+                (getattr(stype, field), value)
+                for field, value in data.items()), guard):
+            store.rollback()
+            raise exceptions.PreconditionException('Object has been changed')
 
     plugin.call_hooks(stype, 'update.precommit', obj, storage=hook_storage)
 
@@ -199,15 +502,27 @@ def delete(stype, key):
     return obj
 
 
-def replace(stype, key_name, key_value, data):
+def replace(stype, key_name, key_value, data, if_match=None):
     '''
     Replace an object
 
+    With L{if_match} the object must still have one of the given row
+    versions. It is then overwritten in place by a conditional UPDATE
+    instead of being removed and created again, so its version keeps
+    counting up. The replace.preset, replace.postset and replace.precommit
+    hooks are called with the new object and replace.postcommit with the
+    object after the write. Columns not in L{data} get their storm default.
+
     @param stype:
     @param key_name:
     @param key_value:
     @param data:
-    @return:
+    @keyword if_match: C{tuple} of row versions, see L{update}.
+    @raises NotfoundException: If the object does not exist.
+    @raises PreconditionException: If the object does not match L{if_match}.
+    @raises ConflictException: If the data collides with another row on a
+        unique key.
+    @return: Instance of L{stype} with the new data.
     '''
     hook_storage = dict()
     store = stormy.Stormy()
@@ -216,9 +531,346 @@ def replace(stype, key_name, key_value, data):
     if not obj:
         plugin.call_hooks(stype, 'replace.notfound', key_value,
                            storage=hook_storage)
+
+        if if_match is not None:
+            _match(obj, if_match)
+
         raise exceptions.NotFoundException
 
     plugin.call_hooks(stype, 'replace.preremove', obj, storage=hook_storage)
-    store.remove(obj)
     data[key_name] = key_value
-    return create(stype, data)
+
+    if if_match is None:
+        store.remove(obj)
+        return create(stype, data)
+
+    _match(obj, if_match)
+    guard = stormy.version_guard(obj)
+    new = stype()
+    plugin.call_hooks(stype, 'replace.preset', new, data, storage=hook_storage)
+    stormy.dict_set(new, data)
+    plugin.call_hooks(stype, 'replace.postset', new, storage=hook_storage)
+    plugin.call_hooks(stype, 'replace.precommit', new, storage=hook_storage)
+
+    try:
+        if not stormy.update_if(store, obj, stormy.replace_values(new),
+                                guard):
+            store.rollback()
+            raise exceptions.PreconditionException('Object has been changed')
+
+        store.mark_written(stype)
+        store.commit()
+    except IntegrityError:
+        store.rollback()
+        raise exceptions.ConflictException('Conflicts with an existing record')
+
+    plugin.call_hooks(stype, 'replace.postcommit', obj, storage=hook_storage)
+    return obj
+
+
+def _batches(items):
+    '''
+    Split L{items} into lists of L{BULK_BATCH_SIZE}.
+
+    @param items: C{list} to split.
+    '''
+    for start in xrange(0, len(items), BULK_BATCH_SIZE):
+        yield items[start:start + BULK_BATCH_SIZE]
+
+
+def _bulk_get(stype, keys):
+    '''
+    Load many objects by primary key with one query per batch.
+
+    @param stype:
+    @param keys: Primary key values.
+    @return: C{dict} of key to object for the keys that exist.
+    '''
+    store = stormy.Stormy()
+    primary = get_cls_info(stype).primary_key
+    found = dict()
+
+    if len(primary) != 1:
+        for key in keys:
+            obj = store.get(stype, key)
+
+            if obj is not None:
+                found[key] = obj
+
+        return found
+
+    for batch in _batches(list(set(keys))):
+        for obj in store.find(stype, primary[0].is_in(batch)):
+            found[primary[0].__get__(obj)] = obj
+
+    return found
+
+
+def _primary_value(obj):
+    '''
+    Get the primary key of an object in the form L{_bulk_get} takes.
+
+    @param obj: Storm object.
+    @return: Column value, or C{tuple} of values for compound keys.
+    '''
+    primary = get_cls_info(obj.__class__).primary_key
+
+    if len(primary) == 1:
+        return primary[0].__get__(obj)
+
+    return tuple(column.__get__(obj) for column in primary)
+
+
+def _bulk_write(store, write, *args):
+    '''
+    Run one bulk write in a savepoint.
+
+    @param store: Store of the transaction.
+    @param write: Function doing the write.
+    @param *args: Arguments for L{write}.
+    @return: ConflictException if the write broke a constraint, the
+        exception raised if a precondition failed or the row is gone, None
+        if it succeeded. The write is rolled back if it failed.
+    '''
+    try:
+        with stormy.Savepoint(store):
+            write(*args)
+    except IntegrityError:
+        return exceptions.ConflictException(
+            'Conflicts with an existing record')
+    except (exceptions.PreconditionException,
+            exceptions.NotFoundException) as execp:
+        return execp
+
+    return None
+
+
+def _bulk_add(store, obj):
+    '''
+    Add an object to the store and insert it right away.
+
+    @param store: Store of the transaction.
+    @param obj: Storm object.
+    '''
+    store.add(obj)
+    store.flush()
+
+
+def _bulk_set(store, stype, obj, data, guard):
+    '''
+    Write L{data} to the row of an object with an UPDATE, see
+    L{stormy.update_if}. The object is not changed before the write, so it
+    stays clean if the write fails.
+
+    @param store: Store of the transaction.
+    @param stype:
+    @param obj: Instance of L{stype}.
+    @param data: C{dict} of data to update object with.
+    @param guard: Condition from L{stormy.version_guard} or None.
+    @raises PreconditionException: If the row does not match L{guard}.
+    @raises NotFoundException: If the row is gone.
+    '''
+    values = dict((getattr(stype, field), value)
+                  for field, value in data.items())
+
+    if stormy.update_if(store, obj, values, guard):
+        return
+
+    if guard is not None:
+        raise exceptions.PreconditionException('Object has been changed')
+
+    raise exceptions.NotFoundException()
+
+
+def bulk_create(stype, items):
+    '''
+    Create many objects of stype in one transaction.
+
+    The create hooks are called for every object. Objects that have their
+    primary key set are written first with multi-row INSERTs of
+    L{BULK_BATCH_SIZE} rows and loaded back after the commit, so they have
+    their database defaults. Objects that need a generated key are added to
+    the store one by one after them so the key is loaded.
+
+    Each write runs in a savepoint. When a batch breaks a constraint its
+    rows are written one at a time, the rows that fail are left out and the
+    rest are still created.
+
+    @param stype:
+    @param items: C{list} of data C{dict}s.
+    @return: C{list} in the order of L{items} of the new objects, or a
+        ConflictException for items that could not be written.
+    '''
+    store = stormy.Stormy()
+    results = []
+    storages = []
+    rows = []
+    added = []
+
+    for data in items:
+        hook_storage = dict()
+        new = stype()
+        plugin.call_hooks(stype, 'create.preset', new, data,
+                          storage=hook_storage)
+        stormy.dict_set(new, data)
+        plugin.call_hooks(stype, 'create.postset', new, storage=hook_storage)
+        plugin.call_hooks(stype, 'create.precommit', new,
+                          storage=hook_storage)
+
+        if stormy.has_primary_key(new):
+            rows.append((len(results), new))
+        else:
+            added.append((len(results), new))
+
+        results.append(new)
+        storages.append(hook_storage)
+
+    for batch in _batches(rows):
+        if _bulk_write(store, stormy.insert_many, store,
+                       [obj for _, obj in batch]) is None:
+            continue
+
+        for index, obj in batch:
+            results[index] = _bulk_write(store, stormy.insert_many, store,
+                                         [obj]) or obj
+
+    for index, obj in added:
+        results[index] = _bulk_write(store, _bulk_add, store, obj) or obj
+
+    store.mark_written(stype)
+    store.commit()
+
+    rows = [(index, _primary_value(obj)) for index, obj in rows
+            if not isinstance(results[index], Exception)]
+    found = _bulk_get(stype, [key for _, key in rows])
+
+    for index, key in rows:
+        results[index] = found.get(key, results[index])
+
+    for new, hook_storage in zip(results, storages):
+        if not isinstance(new, Exception):
+            plugin.call_hooks(stype, 'create.postcommit', new,
+                              storage=hook_storage)
+
+    return results
+
+
+def bulk_update(stype, items):
+    '''
+    Update many objects of stype in one transaction.
+
+    The objects are loaded with one query per L{BULK_BATCH_SIZE} keys and the
+    update hooks are called for every object. The do_commit hook flag is
+    ignored, everything is committed together.
+
+    Each object is written by its own UPDATE in a savepoint, like the
+    conditional writes of L{update}. An item that breaks a constraint gets a
+    ConflictException and an item whose row versions do not match gets a
+    PreconditionException, the other items are still updated.
+
+    @param stype:
+    @param items: C{list} of (key, data) or (key, data, if_match) tuples,
+        see L{update} for if_match.
+    @return: C{list} in the order of L{items} of the updated objects, or the
+        exception of items that failed.
+    '''
+    store = stormy.Stormy()
+    found = _bulk_get(stype, [item[0] for item in items])
+    results = []
+    updated = []
+
+    for item in items:
+        key, data = item[:2]
+        if_match = item[2] if len(item) > 2 else None
+        hook_storage = dict()
+        obj = found.get(key)
+
+        if obj is None:
+            plugin.call_hooks(stype, 'update.notfound', key,
+                              storage=hook_storage)
+            results.append(exceptions.NotFoundException())
+            continue
+
+        guard = None
+
+        if if_match is not None:
+            try:
+                _match(obj, if_match)
+            except exceptions.PreconditionException as execp:
+                results.append(execp)
+                continue
+
+            guard = stormy.version_guard(obj)
+
+        plugin.call_hooks(stype, 'update.preset', obj, data,
+                          storage=hook_storage)
+
+        if hook_storage.get('do_set', True) is not False:
+            error = _bulk_write(store, _bulk_set, store, stype, obj, data,
+                                guard)
+
+            if error is not None:
+                results.append(error)
+                continue
+
+        plugin.call_hooks(stype, 'update.precommit', obj,
+                          storage=hook_storage)
+        results.append(obj)
+        updated.append((obj, hook_storage))
+
+    store.mark_written(stype)
+    store.commit()
+
+    for obj, hook_storage in updated:
+        plugin.call_hooks(stype, 'update.postcommit', obj,
+                          storage=hook_storage)
+
+    return results
+
+
+def bulk_delete(stype, keys):
+    '''
+    Remove many objects of stype in one transaction.
+
+    The delete hooks are called for every object.
+
+    @param stype:
+    @param keys: C{list} of primary key values.
+    @return: C{list} in the order of L{keys} of the removed objects, or a
+        NotFoundException for keys that do not exist.
+    '''
+    store = stormy.Stormy()
+    found = _bulk_get(stype, keys)
+    results = []
+    removed = []
+
+    for key in keys:
+        hook_storage = dict()
+        obj = found.pop(key, None)
+
+        if obj is None:
+            plugin.call_hooks(stype, 'delete.notfound', obj,
+                              storage=hook_storage)
+            results.append(exceptions.NotFoundException())
+            continue
+
+        plugin.call_hooks(stype, 'delete.preremove', obj,
+                          storage=hook_storage)
+        # Removed through the store like in delete, the objects stay
+        # readable for the postcommit hooks and the response.
+        store.remove(obj)
+        results.append(obj)
+        removed.append((key, obj, hook_storage))
+
+    for _, obj, hook_storage in removed:
+        plugin.call_hooks(stype, 'delete.precommit', obj,
+                          storage=hook_storage)
+
+    store.mark_written(stype)
+    store.commit()
+
+    for _, obj, hook_storage in removed:
+        plugin.call_hooks(stype, 'delete.postcommit', obj,
+                          storage=hook_storage)
+
+    return results
@@ -0,0 +1,396 @@
+# Copyright (c) 2013 Ask.com.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+# Any express or implied warranties, including, without limitation, the implied
+# warranties of merchantability and fitness for a particular purpose and any
+# warranty of non-infringement are disclaimed.  The copyright owner and
+# contributors shall not be liable for any direct, indirect, incidental,
+# special, punitive, exemplary, or consequential damages (including, without
+# limitation, procurement of substitute goods or services; loss of use, data or
+# profits; or business interruption) however caused and under any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence) or otherwise arising in any way out of the use of or inability to
+# use the software, even if advised of the possibility of such damage.  The
+# foregoing limitations of liability shall apply even if deemed to fail of
+# their essential purpose.  The software may only be distributed under the
+# terms of the License and this disclaimer.
+'''
+Per route database query profiling and slow query log.
+
+A storm tracer records the statements run by the current L{Profile}: how
+many, how long they took and how often each statement shape was repeated.
+Statements differing only by their parameters share a shape, so a shape run
+many times in one route is usually an N+1 query pattern.
+
+Statements slower than woodstove.storm.slow_threshold seconds are written to
+the L{SlowLog}.
+'''
+
+import re
+import json
+import time
+import logging
+import threading
+import collections
+from storm.tracer import install_tracer
+from woodstove.common import logger, config
+
+
+# Profiles of the most recent routes, see L{recent}.
+RECENT_SIZE = 100
+
+__recent__ = collections.deque(maxlen=RECENT_SIZE)
+__tracer__ = None
+
+# Parameter lists (IN clauses) of any length give the same shape. Storm has
+# replaced its ? marks with the driver's marks by the time statements are
+# traced.
+_PARAM_LIST = re.compile(r'\((?:\?|%s)(?:\s*,\s*(?:\?|%s))*\)')
+
+# Start time of the statement running in each thread.
+_timing = threading.local()
+
+
+def install(conf):
+    '''
+    Install the tracer in storm if profiling or the slow query log is turned
+    on. Calling this more than once does nothing.
+
+    @param conf: C{dict} of woodstove.storm settings.
+    '''
+    global __tracer__
+
+    if __tracer__ is not None:
+        return
+
+    slow_log = None
+
+    if conf.get('slow_threshold') is not None:
+        slow_log = SlowLog(conf['slow_threshold'],
+                           conf.get('slow_log_rate', 60),
+                           conf.get('slow_log'))
+
+    if conf.get('profile', True) or slow_log is not None:
+        __tracer__ = QueryTracer(conf.get('profile', True), slow_log)
+        install_tracer(__tracer__)
+
+
+def current():
+    '''
+    Get the profile of the current thread.
+
+    @return: L{Profile} or None.
+    '''
+    return getattr(threading.currentThread(), 'stormy_profile', None)
+
+
+def recent():
+    '''
+    Get the summaries of the most recent profiles, newest first.
+
+    @return: C{list} of C{dict}s, see L{Profile.summary}.
+    '''
+    return list(reversed(__recent__))
+
+
+def shape(statement):
+    '''
+    Get the shape of a statement.
+
+    @param statement: SQL statement with parameter marks.
+    @return: L{statement} with parameter lists collapsed.
+    '''
+    return _PARAM_LIST.sub('(?, ...)', statement)
+
+
+class QueryTracer(object):
+    '''
+    Storm tracer timing every statement for the current L{Profile} and the
+    L{SlowLog}. Statements under the slow threshold only cost the timing and
+    the profile lookup.
+
+    @ivar profile: Record statements in the current profile.
+    @ivar slow_log: L{SlowLog} or None.
+    '''
+
+    def __init__(self, profile=True, slow_log=None):
+        '''
+        @keyword profile: Record statements in the current profile.
+        @keyword slow_log: L{SlowLog} for slow statements.
+        '''
+        self.profile = profile
+        self.slow_log = slow_log
+
+    def connection_raw_execute(self, connection, raw_cursor, statement,
+                               params):
+        ''' Statement is about to run '''
+        _timing.started = time.time()
+
+    def connection_raw_execute_success(self, connection, raw_cursor,
+                                       statement, params):
+        ''' Statement ran '''
+        self._finished(connection, statement, params)
+
+    def connection_raw_execute_error(self, connection, raw_cursor, statement,
+                                     params, error):
+        ''' Statement failed '''
+        self._finished(connection, statement, params)
+
+    def _finished(self, connection, statement, params):
+        '''
+        Record a statement that finished running.
+
+        @param connection: Storm connection the statement ran on.
+        @param statement: SQL statement.
+        @param params: Statement parameters.
+        '''
+        now = time.time()
+        duration = now - getattr(_timing, 'started', now)
+        profile = current()
+
+        if self.profile and profile is not None:
+            profile.record(statement, duration)
+
+        if self.slow_log is not None and duration >= self.slow_log.threshold:
+            name = profile.name if profile is not None else \
+                threading.currentThread().name
+            self.slow_log.record(connection, statement, params, duration,
+                                 name)
+
+
+class SlowLog(object):
+    '''
+    Rate limited log of slow statements. Every entry is a JSON object with
+    the statement, parameters, duration in milliseconds, the route or job
+    that ran it and, for SELECTs, the EXPLAIN output. EXPLAIN runs in a
+    background thread on its own connection.
+
+    @ivar threshold: Seconds above which a statement is logged.
+    @ivar rate: Maximum entries per minute, entries over it are counted in
+        the suppressed field of the next entry.
+    '''
+
+    def __init__(self, threshold, rate=60, path=None):
+        '''
+        @param threshold: Seconds above which a statement is logged.
+        @keyword rate: Maximum entries per minute.
+        @keyword path: File to write the entries to, they go to the
+            woodstove.slowlog logger if this is not specified.
+        '''
+        self.threshold = threshold
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.window = 0
+        self.logged = 0
+        self.suppressed = 0
+        self.log = logger.Logger('woodstove.slowlog')
+
+        if path:
+            logger.to_file(path, logging.INFO, '%(message)s',
+                           name='woodstove.slowlog')
+            self.log.propagate = False
+
+    def allow(self):
+        '''
+        Check the rate limit.
+
+        @return: Number of entries suppressed since the last one, None if this
+            entry is suppressed too.
+        '''
+        with self.lock:
+            window = int(time.time() // 60)
+
+            if window != self.window:
+                self.window = window
+                self.logged = 0
+
+            if self.logged >= self.rate:
+                self.suppressed += 1
+                return None
+
+            self.logged += 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+    def record(self, connection, statement, params, duration, name):
+        '''
+        Log a slow statement.
+
+        @param connection: Storm connection the statement ran on.
+        @param statement: SQL statement.
+        @param params: Statement parameters.
+        @param duration: Seconds the statement took.
+        @param name: Route or job that ran the statement.
+        '''
+        suppressed = self.allow()
+
+        if suppressed is None:
+            return
+
+        params = tuple(connection.to_database(params))
+        entry = {
+            'time': time.time(),
+            'source': name,
+            'duration': round(duration * 1000, 3),
+            'statement': statement,
+            'params': [repr(x) for x in params],
+            'suppressed': suppressed,
+        }
+
+        if not statement.lstrip().upper().startswith('SELECT'):
+            self.write(entry)
+            return
+
+        thread = threading.Thread(target=self.explain,
+                                  args=(connection._database, statement,
+                                        params, entry))
+        thread.daemon = True
+        thread.start()
+
+    def explain(self, database, statement, params, entry):
+        '''
+        Add the EXPLAIN output of a statement to an entry and write it.
+
+        @param database: Storm database to connect to.
+        @param statement: SQL statement.
+        @param params: Database values of the parameters.
+        @param entry: Log entry.
+        '''
+        try:
+            raw_connection = database.raw_connect()
+
+            try:
+                cursor = raw_connection.cursor()
+                cursor.execute('EXPLAIN ' + statement, params)
+                columns = [x[0] for x in cursor.description]
+                entry['explain'] = [dict(zip(columns, row))
+                                    for row in cursor.fetchall()]
+            finally:
+                raw_connection.close()
+        except Exception as execp:
+            entry['explain_error'] = str(execp)
+
+        self.write(entry)
+
+    def write(self, entry):
+        '''
+        Write an entry to the log.
+
+        @param entry: Log entry.
+        '''
+        self.log.warning(json.dumps(entry, default=str))
+
+
+class Profile(object):
+    '''
+    Context manager profiling the queries of a route call. Nested profiles
+    leave the outer one in charge.
+
+    @ivar name: Name of the profiled route.
+    @ivar count: Number of statements run.
+    @ivar time: Seconds spent running statements.
+    @ivar shapes: C{Counter} of statement shapes.
+    '''
+    _nested = False
+
+    def __init__(self, name):
+        '''
+        @param name: Name of the profiled route.
+        '''
+        self.name = name
+        self.count = 0
+        self.time = 0.0
+        self.shapes = collections.Counter()
+
+    def __enter__(self):
+        ''' Make this the current profile '''
+        thread = threading.currentThread()
+
+        if getattr(thread, 'stormy_profile', None) is not None:
+            self._nested = True
+        else:
+            thread.stormy_profile = self
+
+        return self
+
+    def __exit__(self, *_):
+        ''' Stop profiling, warn about repeated shapes and keep a summary '''
+        if self._nested:
+            return
+
+        threading.currentThread().stormy_profile = None
+
+        if not self.count:
+            return
+
+        limit = config.Config().woodstove.storm.dict.get('repeat_warning', 10)
+
+        for statement, count in self.shapes.most_common():
+            if count <= limit:
+                break
+
+            logger.Logger(__name__).warning(
+                "%s ran the same query %d times: %s" % (self.name, count,
+                                                        statement))
+
+        __recent__.append(self.summary())
+
+    def record(self, statement, duration):
+        '''
+        Record a statement that finished running.
+
+        @param statement: SQL statement.
+        @param duration: Seconds the statement took.
+        '''
+        self.time += duration
+        self.count += 1
+        self.shapes[shape(statement)] += 1
+
+    @property
+    def repeats(self):
+        '''
+        Number of statements that repeated an earlier shape.
+        '''
+        return self.count - len(self.shapes)
+
+    def summary(self, top=10):
+        '''
+        Summarize the profile.
+
+        @keyword top: Number of most repeated shapes to include.
+        @return: C{dict} of the profile.
+        '''
+        return {
+            'name': self.name,
+            'count': self.count,
+            'time': round(self.time * 1000, 3),
+            'repeats': self.repeats,
+            'shapes': [{'statement': statement, 'count': count}
+                       for statement, count in self.shapes.most_common(top)
+                       if count > 1],
+        }
+
+    def headers(self):
+        '''
+        Get the response headers of the profile, only when woodstove.storm
+        debug is on.
+
+        @return: C{list} of (name, value) tuples.
+        '''
+        if not config.Config().woodstove.storm.dict.get('debug', False):
+            return []
+
+        return [('X-DB-Queries', str(self.count)),
+                ('X-DB-Time', '%.3f' % (self.time * 1000)),
+                ('X-DB-Repeats', str(self.repeats))]
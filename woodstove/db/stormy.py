@@ -27,17 +27,36 @@
 # terms of the License and this disclaimer.
 ''' Storm related stuff '''
 
+import sys
 import time
+import json
+import hashlib
+import base64
 import datetime
-from storm.locals import create_database, Store, And, Desc
-from storm.expr import BinaryOper, compile as storm_compile
-from storm.info import get_cls_info
-from storm.store import ResultSet
+import random
+import functools
+import threading
+import collections
+from storm.locals import create_database, Store, And, Or, Desc, Max
+from storm.expr import (BinaryOper, State, Insert, Update, SQLRaw,
+                        Expr, Column, Like, Select, Count, Coalesce, Undef,
+                        compare_columns, compile as storm_compile)
+from storm.info import get_cls_info, get_obj_info
+from storm.database import convert_param_marks
+from storm.store import ResultSet, FindSpec
+from storm.variables import UnicodeVariable
 from storm.references import BoundReferenceSet
-from storm.tracer import debug
+from storm.tracer import debug, trace
 from storm.exceptions import DisconnectionError, ClassInfoError
 from woodstove import exceptions
 from woodstove.common import logger, config, stateful
+from woodstove.db import profiler
+
+try:
+    from MySQLdb.connections import Connection as MySQLConnection
+    from MySQLdb.cursors import SSCursor
+except ImportError:
+    MySQLConnection = SSCursor = None
 
 
 def inspect(cls):
@@ -71,6 +90,130 @@ def inspect(cls):
         yield (name, column, prop)
 
 
+__serializers__ = dict()
+__written__ = dict()
+__counts__ = dict()
+__retries__ = {'retries': 0, 'recovered': 0, 'failed': 0}
+__statements__ = dict()
+__versions__ = dict()
+__statement_stats__ = {'hits': 0, 'misses': 0, 'compile_time': 0.0}
+
+TOTALS = ('exact', 'estimated', 'none')
+
+# Maximum number of cached counts per class.
+COUNT_CACHE_SIZE = 1000
+
+# Maximum number of cached compiled statements.
+STATEMENT_CACHE_SIZE = 1000
+
+# Property types whose values json can encode as they are.
+PLAIN_PROPERTIES = frozenset(['Bool', 'Int', 'Float', 'Decimal', 'RawStr',
+                              'Unicode', 'JSON'])
+
+# Formats accepted for date and time filter operands. The first is how
+# DateTime values are serialized.
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+                    '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d')
+
+
+def _convert_datetime(value):
+    '''
+    Convert a DateTime column value to a string.
+
+    @param value: Column value.
+    @return: C{str} of the value or None.
+    '''
+    if value is None:
+        return value
+
+    return str(value)
+
+
+def _convert_value(value):
+    '''
+    Convert a column value of unknown type.
+
+    @param value: Column value.
+    @return: Converted value.
+    '''
+    if isinstance(value, datetime.datetime):
+        return str(value)
+
+    if callable(value):
+        return value.__name__
+
+    return value
+
+
+def serializer(cls):
+    '''
+    Get the serializer plan for a storm class.
+
+    The plan is built once per class and cached. It is rebuilt if storm's
+    class info for L{cls} is replaced.
+
+    @param cls: Storm class.
+    @return: C{tuple} of (name, converter) pairs for the visible columns.
+        converter is None for values that do not need converting.
+    @raise InternalException: If L{cls} is not a Storm class.
+    '''
+    try:
+        info, plan = __serializers__[cls]
+
+        if get_cls_info(cls) is info:
+            return plan
+    except KeyError:
+        pass
+
+    plan = []
+
+    for name, column, property in inspect(cls):
+        if getattr(property, '_stove_hidden', False):
+            continue
+
+        kind = property.__class__.__name__
+
+        if kind in PLAIN_PROPERTIES:
+            plan.append((name, None))
+        elif kind == 'DateTime':
+            plan.append((name, _convert_datetime))
+        else:
+            plan.append((name, _convert_value))
+
+    plan = tuple(plan)
+    __serializers__[cls] = (get_cls_info(cls), plan)
+    return plan
+
+
+def reset_serializers(cls=None):
+    '''
+    Drop cached serializer plans.
+
+    @keyword cls: Only drop the plan for this class.
+    '''
+    if cls is None:
+        __serializers__.clear()
+    else:
+        __serializers__.pop(cls, None)
+
+
+def _serialize(obj, plan):
+    '''
+    Convert a storm object to a C{dict} using a serializer plan.
+
+    @param obj: Storm object.
+    @param plan: Plan from L{serializer}.
+    @return: C{dict} representation of L{obj}.
+    '''
+    result = {}
+
+    for name, convert in plan:
+        value = getattr(obj, name)
+        result[name] = value if convert is None else convert(value)
+
+    return result
+
+
 def storm_to_dict(obj):
     '''
     Transform storm result object into dict
@@ -82,22 +225,43 @@ def storm_to_dict(obj):
     if not hasattr(obj, "__storm_table__"):
         raise TypeError(repr(obj) + " is not JSON serializable!!!")
 
-    result = {}
+    return _serialize(obj, serializer(obj.__class__))
+
+
+def projection(cls, fields):
+    '''
+    Get the serializer plan for a subset of the columns of a storm class.
+
+    @param cls: Storm class.
+    @param fields: Iterable of column names.
+    @return: C{tuple} of (name, converter) pairs in the order of L{fields}.
+    @raise RequestException: If a field is unknown or hidden.
+    '''
+    plan = dict(serializer(cls))
+    result = []
 
-    for name, column, property in inspect(obj.__class__):
+    for name in fields:
         try:
-            if property._stove_hidden:
-                continue
-        except AttributeError:
-            pass
+            result.append((name, plan[name]))
+        except KeyError:
+            raise exceptions.RequestException("Unknown field: %s" % name)
 
-        result[name] = getattr(obj, name)
+    return tuple(result)
 
-        if isinstance(result[name], datetime.datetime):
-            result[name] = str(result[name])
 
-        if callable(result[name]):
-            result[name] = result[name].__name__
+def row_to_dict(row, plan):
+    '''
+    Convert a row selected with a projection to a C{dict}.
+
+    @param row: C{tuple} of column values. Values past the end of the plan
+        are ignored.
+    @param plan: Plan from L{projection}.
+    @return: C{dict} of the projected fields.
+    '''
+    result = {}
+
+    for (name, convert), value in zip(plan, row):
+        result[name] = value if convert is None else convert(value)
 
     return result
 
@@ -114,9 +278,18 @@ def storm_set_to_dict(obj):
         raise TypeError(type(obj) + repr(obj) + " is not JSON serializable!!!")
 
     result = []
+    cls = None
+    plan = None
 
     for item in obj:
-        result.append(storm_to_dict(item))
+        if item.__class__ is not cls:
+            if not hasattr(item, "__storm_table__"):
+                raise TypeError(repr(item) + " is not JSON serializable!!!")
+
+            cls = item.__class__
+            plan = serializer(cls)
+
+        result.append(_serialize(item, plan))
 
     return result
 
@@ -137,6 +310,279 @@ def compile_regex(compiler, expr, state):
 storm_compile.set_precedence(30, Regex)
 
 
+class Param(Expr):
+    '''
+    Filter operand, compiled as a statement parameter. Statements compiled
+    from filters keep track of where each operand went so they can be
+    reused with other operands, see L{Query.filter}.
+
+    @ivar variable: Storm variable holding the operand.
+    '''
+    __slots__ = ('variable',)
+
+    def __init__(self, factory, value):
+        '''
+        @param factory: Variable factory of the column.
+        @param value: Operand.
+        @raise TypeError: If the variable can not hold L{value}.
+        @raise ValueError: If the variable can not hold L{value}.
+        '''
+        self.variable = factory(value=value)
+
+
+@storm_compile.when(Param)
+def compile_param(compiler, expr, state):
+    ''' Compile Param operand '''
+    state.parameters.append(expr.variable)
+    return '?'
+
+
+def has_primary_key(obj):
+    '''
+    Check if all primary key columns of a storm object are set.
+
+    @param obj: Storm object.
+    @return: C{bool}
+    '''
+    obj_info = get_obj_info(obj)
+    return all(obj_info.variables[column].is_defined()
+               for column in obj_info.cls_info.primary_key)
+
+
+class Savepoint(object):
+    '''
+    Run a block in a savepoint of the current transaction. The block's
+    writes are rolled back when it raises, the rest of the transaction is
+    kept.
+
+    >>> with Savepoint(store):
+    ...     insert_many(store, objs)
+
+    Storm objects the block added to the store are not rolled back, so only
+    flushed adds of new objects are safe to discard after an error.
+    '''
+    name = 'woodstove'
+
+    def __init__(self, store):
+        '''
+        @param store: Store of the transaction.
+        '''
+        self.store = store
+
+    def __enter__(self):
+        '''
+        Start the savepoint, pending changes are flushed first.
+        '''
+        self.store.execute('SAVEPOINT %s' % self.name, noresult=True)
+        return self
+
+    def __exit__(self, extype, *_):
+        '''
+        Roll back to the savepoint if the block raised, release it otherwise.
+        '''
+        if extype is None:
+            self.store.execute('RELEASE SAVEPOINT %s' % self.name,
+                               noresult=True)
+        else:
+            self.store.execute('ROLLBACK TO SAVEPOINT %s' % self.name,
+                               noresult=True)
+
+
+def insert_many(store, objs):
+    '''
+    Insert storm objects of one class with a single multi-row INSERT.
+
+    The objects are not added to the store, so database side defaults and
+    generated keys are not loaded into them. Columns that are not set on an
+    object get the column default.
+
+    @param store: Store to execute the insert with.
+    @param objs: Storm objects to insert.
+    '''
+    if not objs:
+        return
+
+    cls_info = get_obj_info(objs[0]).cls_info
+    infos = [get_obj_info(obj) for obj in objs]
+    columns = [column for column in cls_info.columns
+               if any(info.variables[column].is_defined() for info in infos)]
+    default = SQLRaw('DEFAULT')
+    rows = []
+
+    for info in infos:
+        row = []
+
+        for column in columns:
+            variable = info.variables[column]
+            row.append(variable if variable.is_defined() else default)
+
+        rows.append(tuple(row))
+
+    store.execute(Insert(columns, table=cls_info.table, values=rows),
+                  noresult=True)
+
+
+def version_column(cls):
+    '''
+    Get the column of a storm class flagged with L{version}.
+
+    @param cls: Storm class.
+    @return: Column, None if the class has no version column.
+    '''
+    try:
+        return __versions__[cls]
+    except KeyError:
+        pass
+
+    column = None
+
+    for _, col, prop in inspect(cls):
+        if getattr(prop, '_stove_version', False):
+            column = col
+            break
+
+    __versions__[cls] = column
+    return column
+
+
+def row_version(obj):
+    '''
+    Get a token that changes whenever the row behind L{obj} changes. This is
+    the value of the version column, or a hash of every column if the class
+    has none.
+
+    @param obj: Storm object.
+    @return: C{str}
+    '''
+    obj_info = get_obj_info(obj)
+    column = version_column(obj_info.cls_info.cls)
+
+    if column is not None:
+        return str(obj_info.variables[column].get())
+
+    values = [obj_info.variables[col].get()
+              for col in obj_info.cls_info.columns]
+    return hashlib.sha1(json.dumps(values, sort_keys=True,
+                                   default=unicode)).hexdigest()
+
+
+def bump_version(obj):
+    '''
+    Increment the version column of L{obj} in the database when it is
+    flushed. The new value is loaded on the next access.
+
+    @param obj: Storm object.
+    '''
+    obj_info = get_obj_info(obj)
+    column = version_column(obj_info.cls_info.cls)
+
+    if column is not None:
+        obj_info.variables[column].set(Coalesce(column, 0) + 1)
+
+
+def version_guard(obj):
+    '''
+    Build the condition that the row behind L{obj} still has the version
+    L{row_version} was computed from, for L{update_if}. Call it before
+    changing L{obj}.
+
+    Without a version column the row version is a hash of the row, which can
+    only be checked against the row as it was loaded. Comparing every column
+    in the UPDATE instead would fail on float and serialized columns that do
+    not compare equal to their own value, so there is no condition and the
+    check is not atomic. Flag a version column to close that window.
+
+    @param obj: Storm object.
+    @return: Storm expression, None if the class has no version column.
+    '''
+    obj_info = get_obj_info(obj)
+    column = version_column(obj_info.cls_info.cls)
+
+    if column is None:
+        return None
+
+    return column == obj_info.variables[column].get()
+
+
+def replace_values(new):
+    '''
+    Get the values overwriting a row with L{new} for L{update_if}: every
+    column's value in L{new}, or the column's default if L{new} does not set
+    it. The primary key and the version column are left out.
+
+    @param new: Storm object with the new values.
+    @return: C{dict} of column to value.
+    '''
+    new_info = get_obj_info(new)
+    cls_info = new_info.cls_info
+    version = version_column(cls_info.cls)
+    # Columns compare into expressions, so the key is matched by identity.
+    primary = set(id(column) for column in cls_info.primary_key)
+    values = {}
+
+    for column in cls_info.columns:
+        if id(column) in primary or column is version:
+            continue
+
+        variable = new_info.variables[column]
+
+        if not variable.is_defined():
+            variable = column.variable_factory()
+
+        values[column] = variable.get()
+
+    return values
+
+
+def update_if(store, obj, values, where):
+    '''
+    Write L{values} to the row of L{obj} with an UPDATE that only matches
+    the row if L{where} holds as well. This replaces row locks for
+    optimistic concurrency, see L{version_guard}. The version column is
+    incremented too. L{obj} must not have unflushed changes of its own, it
+    is invalidated and loads the new values on the next access.
+
+    @param store: Store L{obj} belongs to.
+    @param obj: Storm object.
+    @param values: C{dict} of column to new value.
+    @param where: Extra condition for the UPDATE or None.
+    @return: False if the row did not match, True if it was updated or
+        there was nothing to update.
+    @raise TypeError: If a value does not fit its column.
+    '''
+    if not values:
+        return True
+
+    obj_info = get_obj_info(obj)
+    cls_info = obj_info.cls_info
+    changes = {}
+
+    for column, value in values.items():
+        if not isinstance(value, Expr):
+            value = column.variable_factory(value=value)
+
+        changes[column] = value
+
+    version = version_column(cls_info.cls)
+
+    if version is not None:
+        changes[version] = Coalesce(version, 0) + 1
+
+    primary = [obj_info.variables[column] for column in cls_info.primary_key]
+    condition = compare_columns(cls_info.primary_key, primary)
+
+    if where is not None:
+        condition = And(condition, where)
+
+    result = store.execute(Update(changes, condition, cls_info.table))
+
+    if result.rowcount != 1:
+        return False
+
+    store.invalidate(obj)
+    return True
+
+
 def dict_set(obj, data):
     ''' Helper function for setting storm values from a dict '''
     for field, value in data.items():
@@ -144,23 +590,217 @@ def dict_set(obj, data):
     return obj
 
 
+def changes(obj, data):
+    '''
+    Get the part of L{data} that differs from the values of L{obj}. Values
+    are converted by the column's variable before comparing, so equal values
+    in another form are not changes. Values the column does not accept are
+    kept so setting them raises as usual.
+
+    @param obj: Storm object.
+    @param data: C{dict} of field names to new values.
+    @return: C{dict} of changed fields.
+    '''
+    cls = type(obj)
+    changed = {}
+
+    for field, value in data.iteritems():
+        try:
+            variable = getattr(cls, field).variable_factory(value=value)
+        except (AttributeError, TypeError, ValueError):
+            changed[field] = value
+            continue
+
+        if variable.get() != getattr(obj, field):
+            changed[field] = value
+
+    return changed
+
+
+def _parse_datetime(value):
+    '''
+    Parse a date and time string in one of L{DATETIME_FORMATS}. A trailing
+    Z for UTC is ignored.
+
+    @param value: C{str} or C{unicode}.
+    @return: C{datetime}
+    @raise ValueError: If L{value} is not in a known format.
+    '''
+    value = value.strip()
+
+    if value.endswith('Z'):
+        value = value[:-1]
+
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError("Unknown date format: %r" % value)
+
+
+def _param(column, value, params, factory=None):
+    '''
+    Make a L{Param} comparing L{value} with L{column}. Strings are parsed
+    for date and time columns, the API returns their values as strings.
+
+    @param column: Storm column.
+    @param value: Value from the filter.
+    @param params: C{list} the new param is appended to.
+    @keyword factory: Variable factory, the column's if not specified.
+    @return: L{Param}
+    @raise RequestException: If the column can not hold L{value}.
+    '''
+    factory = factory or column.variable_factory
+
+    try:
+        param = Param(factory, value)
+    except (TypeError, ValueError):
+        param = None
+
+        if isinstance(value, basestring):
+            try:
+                param = Param(factory, _parse_datetime(value))
+            except (TypeError, ValueError):
+                pass
+
+        if param is None:
+            raise exceptions.RequestException("Invalid value for %s: %r" % (
+                                              column.name, value))
+
+    params.append(param)
+    return param
+
+
+def _filter_in(column, value, params):
+    ''' Compile the `in` filter operator '''
+    if not isinstance(value, list) or not value:
+        raise exceptions.RequestException("%s: in needs a non-empty list" %
+                                          column.name)
+
+    return column.is_in([_param(column, x, params) for x in value])
+
+
+def _filter_prefix(column, value, params):
+    ''' Compile the `prefix` filter operator '''
+    if not value:
+        raise exceptions.RequestException("Empty prefix in query")
+
+    if not isinstance(value, unicode):
+        raise exceptions.RequestException("Invalid value for %s: %r" % (
+                                          column.name, value))
+
+    pattern = value.replace(u'!', u'!!').replace(u'_', u'!_').replace(
+        u'%', u'!%') + u'%'
+    return Like(column, _param(column, pattern, params), u'!')
+
+
+def _filter_regex(column, value, params):
+    ''' Compile the `regex` filter operator '''
+    if not value:
+        raise exceptions.RequestException("Empty regex in query")
+
+    return Regex(column, _param(column, value, params, UnicodeVariable))
+
+
+FILTER_OPERATORS = {
+    'eq': lambda column, value, params: column == _param(column, value,
+                                                         params),
+    'ne': lambda column, value, params: column != _param(column, value,
+                                                         params),
+    'lt': lambda column, value, params: column < _param(column, value,
+                                                        params),
+    'lte': lambda column, value, params: column <= _param(column, value,
+                                                          params),
+    'gt': lambda column, value, params: column > _param(column, value,
+                                                        params),
+    'gte': lambda column, value, params: column >= _param(column, value,
+                                                          params),
+    'null': lambda column, value, params: (column == None if value
+                                           else column != None),
+    'in': _filter_in,
+    'prefix': _filter_prefix,
+    'regex': _filter_regex,
+}
+
+
 def gen_expr(stype, data):
-    ''' '''
-    expr = None
+    '''
+    Compile a filter C{dict} into a storm expression.
+
+    The keys of L{data} are column names. A plain value matches the column
+    exactly and a list matches any of its values. A C{dict} value maps
+    operators to operands, all of which must match::
+
+        {"name": {"prefix": "web"}, "state": [1, 5], "end_time": {"null": true}}
+
+    The operators are eq, ne, lt, lte, gt, gte, in, prefix, null and regex.
+    All but regex can use an index. regex compiles to MySQL REGEXP and always
+    scans the table.
+
+    @param stype: Storm class being filtered.
+    @param data: Filter C{dict}.
+    @return: Storm expression or None if L{data} has no known columns.
+    @raise RequestException: If the filter is invalid.
+    '''
+    return _gen_expr(stype, data, [], [])
+
+
+def _gen_expr(stype, data, params, shape):
+    '''
+    L{gen_expr} keeping track of the operands.
+
+    @param stype: Storm class being filtered.
+    @param data: Filter C{dict}.
+    @param params: C{list} the operand L{Param}s are appended to.
+    @param shape: C{list} a description of every term is appended to. Filters
+        with the same shape compile to the same statement.
+    @return: Storm expression or None if L{data} has no known columns.
+    @raise RequestException: If the filter is invalid.
+    '''
+    terms = []
 
     for column in get_cls_info(stype).columns:
         try:
-            regex = data[column.name]
+            value = data[column.name]
         except KeyError:
             continue
 
-        if not regex:
-            raise exceptions.RequestException("Empty regex in query")
-
-        cur = Regex(column, regex)
-        expr = And(expr, cur) if expr else cur
-
-    return expr
+        if isinstance(value, dict):
+            if not value:
+                raise exceptions.RequestException("Empty filter for %s" %
+                                                  column.name)
+
+            for oper, operand in sorted(value.iteritems()):
+                try:
+                    compiler = FILTER_OPERATORS[oper]
+                except KeyError:
+                    raise exceptions.RequestException("Unknown operator: %s" %
+                                                      oper)
+
+                terms.append(compiler(column, operand, params))
+
+                if oper == 'in':
+                    shape.append((column.name, oper, len(operand)))
+                elif oper == 'null':
+                    shape.append((column.name, oper, bool(operand)))
+                else:
+                    shape.append((column.name, oper, None))
+        elif isinstance(value, list):
+            terms.append(_filter_in(column, value, params))
+            shape.append((column.name, 'in', len(value)))
+        elif value is None:
+            terms.append(column == None)
+            shape.append((column.name, 'null', True))
+        else:
+            terms.append(column == _param(column, value, params))
+            shape.append((column.name, 'eq', None))
+
+    if not terms:
+        return None
+
+    return And(*terms) if len(terms) > 1 else terms[0]
 
 
 class Query(object):
@@ -174,6 +814,12 @@ class Query(object):
     offset = None
     distinct = False
     desc = False
+    readonly = False
+    plan = None
+    columns = None
+    params = ()
+    shape = ()
+    _filtered = None
     _limit = None
     _results = None
 
@@ -197,87 +843,1313 @@ class Query(object):
         '''
         self._limit = value
 
-    @property
-    def results(self):
+    def project(self, fields):
         '''
+        Only select the columns for L{fields}. L{execute} then returns dicts
+        instead of objects, and L{results} returns tuples of the values in
+        L{columns}.
+
+        @param fields: Iterable of column names.
+        @raise RequestException: If a field is unknown or hidden.
         '''
-        if not self._results:
-            store = Stormy()
+        self.plan = projection(self.table, fields)
+        self.columns = tuple(getattr(self.table, name)
+                             for name, _ in self.plan)
 
-            if self.using:
-                store = store.using(*self.using)
+    def filter(self, data):
+        '''
+        Set L{where} from a filter C{dict}, see L{gen_expr}.
 
-            if self.where:
-                self._results = store.find(self.table, self.where)
-            else:
-                self._results = store.find(self.table)
-           
-            if self.order:
-                order = self.order
+        The statements of filtered queries are compiled once per filter shape
+        (the columns, operators and number of operands), projection and sort
+        and run again with the operands of the next query of the same shape.
+        Queries whose where, using or order are changed afterwards are
+        compiled every time.
 
-                if self.desc:
-                    order = Desc(order)
+        @param data: Filter C{dict}.
+        @raise RequestException: If the filter is invalid.
+        '''
+        params = []
+        shape = []
+        self.where = self._filtered = _gen_expr(self.table, data, params,
+                                                shape)
+        self.params = params
+        self.shape = tuple(shape)
+
+    def _store(self):
+        '''
+        Get the store to run this query with.
 
-                self._results = self._results.order_by(order)
+        @return: Storm store.
+        '''
+        store = Stormy()
 
-            self._results.config(distinct=self.distinct)
+        if self.readonly:
+            store = store.reader(self.table)
 
-        return self._results
+        return store.store if isinstance(store, Stormy) else store
 
-    def execute(self):
+    def _order_by(self):
         '''
+        Get the order by expressions of this query.
+
+        @return: C{list} of expressions.
         '''
-        return (self.results[self.offset:self.limit], self.results.count())
+        if self.order is None:
+            return []
 
+        order = self.order
 
-class Stormy(object):  # pylint: disable=R0903
-    ''' Stateful class for accessing storm '''
+        if not isinstance(order, (list, tuple)):
+            order = (order,)
 
-    # pylint: disable=W0212
+        if self.desc:
+            order = [Desc(x) for x in order]
 
-    __database = None
+        return list(order)
 
-    @stateful.threadstate
-    def __init__(self, dsn=None):
-        ''' Setup or fetch state '''
-        self.conf = config.Config().woodstove.storm
-        if not self.__class__.__database:
-            if not dsn:
-                dsn = self.conf.dsn
+    def _statement(self, kind, store):
+        '''
+        Get the compiled statement of this query from the statement cache,
+        compiling it if it is not cached yet.
+
+        @param kind: 'select' or 'count'.
+        @param store: Store the statement will run on.
+        @return: C{tuple} of the statement, its parameters (indexes in
+            L{params} for the operands) and the find spec, or None if the
+            statement can not be cached.
+        '''
+        if self.where is not self._filtered or self.using:
+            return None
 
-            if self.conf.debug:
-                debug(True, stream=open(self.conf.file, 'a+'))
+        if kind == 'count' and self.distinct:
+            return None
 
-            self.__class__.__database = create_database(dsn)
-        self.store = Store(self.__class__.__database)
-        self.poke = time.time()
+        order = self._order_by()
+        order_key = []
 
-    def __stateinit__(self, dsn=None):  # pylint: disable=W0613
-        ''' per instance setup '''
-        now = time.time()
+        for expr in order:
+            column = expr.expr if isinstance(expr, Desc) else expr
 
-        try:
-            self.store._connection._ensure_connected()
-            if now - self.poke > 14400:
-                self.store.execute("DO 0", noresult=True)
-        except DisconnectionError:
-            msg = "Lost connection to database reconnecting"
-            logger.Logger(__name__).warn(msg)
-            self.store.rollback()
+            if not isinstance(column, Column):
+                return None
 
-        self.poke = now
+            order_key.append((column.name, isinstance(expr, Desc)))
 
-    def __getattr__(self, name):
-        ''' pass request into storm '''
-        return getattr(self.store, name)
+        columns = self.columns
+        key = (kind, self.table, self.shape, self.distinct)
 
-    def reset_timeouts(self):
-        ''' reset poke value to 0 '''
-        self.poke = 0
+        if kind == 'select':
+            key += (tuple(x.name for x in columns) if columns else None,
+                    tuple(order_key))
 
+        try:
+            entry = __statements__[key]
+            __statement_stats__['hits'] += 1
+            return entry
+        except KeyError:
+            pass
 
-def required(obj, funcs=None):
-    ''' setup required for `obj` '''
+        started = time.time()
+        find_spec = FindSpec(columns if columns else self.table)
+        select_columns, tables = find_spec.get_columns_and_tables()
+        where = Undef if self.where is None else self.where
+
+        if kind == 'count':
+            select = Select(Count(), where, default_tables=tables)
+        else:
+            select = Select(select_columns, where, default_tables=tables,
+                            order_by=order or Undef, distinct=self.distinct)
+
+        state = State()
+        statement = store._connection.compile(select, state)
+        slots = dict((id(param.variable), index)
+                     for index, param in enumerate(self.params))
+        entry = (statement,
+                 tuple(slots.get(id(x), x) for x in state.parameters),
+                 find_spec)
+
+        if len(__statements__) >= STATEMENT_CACHE_SIZE:
+            __statements__.clear()
+
+        __statements__[key] = entry
+        __statement_stats__['misses'] += 1
+        __statement_stats__['compile_time'] += time.time() - started
+        return entry
+
+    def _run(self, entry, store, limit=None, offset=None):
+        '''
+        Run a statement from L{_statement} with the operands of this query.
+
+        @param entry: Statement cache entry.
+        @param store: Store to run the statement on.
+        @keyword limit: Maximum number of rows.
+        @keyword offset: Number of rows to skip.
+        @return: Storm result.
+        '''
+        statement, _, _ = entry
+
+        if limit is not None or offset:
+            statement += ' LIMIT %d' % (sys.maxint if limit is None
+                                        else limit)
+
+            if offset:
+                statement += ' OFFSET %d' % offset
+
+        return store.execute(statement, self._operands(entry))
+
+    def _operands(self, entry):
+        '''
+        Get the parameters of a statement from L{_statement} filled in with
+        the operands of this query.
+
+        @param entry: Statement cache entry.
+        @return: C{list} of storm variables.
+        '''
+        return [self.params[x].variable if isinstance(x, int) else x
+                for x in entry[1]]
+
+    @property
+    def results(self):
+        '''
+        '''
+        if not self._results:
+            store = Stormy()
+
+            if self.readonly:
+                store = store.reader(self.table)
+
+            if self.using:
+                store = store.using(*self.using)
+
+            spec = self.columns if self.columns else self.table
+
+            if self.where:
+                self._results = store.find(spec, self.where)
+            else:
+                self._results = store.find(spec)
+           
+            order = self._order_by()
+
+            if order:
+                self._results = self._results.order_by(*order)
+
+            self._results.config(distinct=self.distinct)
+
+        return self._results
+
+    def execute(self, totals='exact'):
+        '''
+        @keyword totals: How to get the total, see L{total}.
+        @return: C{tuple} of the result page and the total. The page is a
+            storm result set, or a C{list} of objects if the statement was
+            cached or of dicts if the query was projected.
+        '''
+        store = self._store()
+        entry = self._statement('select', store)
+
+        if entry is not None:
+            result = self._run(entry, store, self._limit, self.offset)
+            page = [entry[2].load_objects(store, result, values)
+                    for values in result]
+        else:
+            page = self.results[self.offset:self.limit]
+
+        if self.plan is not None:
+            page = [row_to_dict(row, self.plan) for row in page]
+
+        return (page, self.total(totals))
+
+    def iterate(self, batch_size=1000):
+        '''
+        Iterate over all results, ignoring offset and limit, without loading
+        them all into memory. See L{iter_unbuffered}.
+
+        @keyword batch_size: Number of rows fetched at a time.
+        @return: Iterator of objects, or dicts if the query was projected.
+        '''
+        store = self._store()
+        entry = self._statement('select', store)
+
+        if entry is None:
+            rows = iter_unbuffered(self.results, batch_size)
+        elif _unbuffered(store):
+            rows = _iter_unbuffered(store, entry[0], self._operands(entry),
+                                    entry[2], batch_size)
+        else:
+            result = self._run(entry, store)
+            rows = (entry[2].load_objects(store, result, values)
+                    for values in result)
+
+        if self.plan is not None:
+            return (row_to_dict(row, self.plan) for row in rows)
+
+        return rows
+
+    def total(self, mode='exact'):
+        '''
+        Get the number of rows matching the query.
+
+        @keyword mode: 'exact' counts the rows. If woodstove.storm.count_ttl
+            is set the count is cached for that many seconds. The cache is
+            per process and only dropped when this process writes the class,
+            other processes can return counts up to count_ttl seconds old.
+            'estimated' uses the table statistics when the query has no where
+            clause and counts otherwise. 'none' skips the count.
+        @return: Number of rows or None if L{mode} is 'none'.
+        @raise RequestException: If L{mode} is not known.
+        '''
+        if mode not in TOTALS:
+            raise exceptions.RequestException("Invalid totals: %s" % mode)
+
+        if mode == 'none':
+            return None
+
+        if mode == 'estimated' and self.where is None and not self.using:
+            store = Stormy()
+
+            if self.readonly:
+                store = store.reader(self.table)
+
+            return estimate_rows(store, self.table)
+
+        store = self._store()
+        entry = self._statement('count', store)
+        ttl = config.Config().woodstove.storm.dict.get('count_ttl', 0)
+        key = None
+
+        if ttl > 0:
+            try:
+                key = self._count_key(entry)
+            except TypeError:
+                pass
+
+        if key is not None:
+            expires, count = __counts__.get(self.table, {}).get(key, (0, 0))
+
+            if expires > time.time():
+                return count
+
+        if entry is not None:
+            count = self._run(entry, store).get_one()[0]
+        else:
+            count = self.results.count()
+
+        if key is not None:
+            cache = __counts__.setdefault(self.table, dict())
+
+            if len(cache) >= COUNT_CACHE_SIZE:
+                cache.clear()
+
+            cache[key] = (time.time() + ttl, count)
+
+        return count
+
+    def version(self, column):
+        '''
+        Get the number of rows matching the query and the largest value of
+        L{column} with one query, ignoring offset and limit. With a column
+        holding the time of the last change this tells if the results
+        changed without fetching them.
+
+        @param column: Column to get the largest value of.
+        @return: C{tuple} of the number of rows and the largest value.
+        '''
+        store = Stormy()
+
+        if self.readonly:
+            store = store.reader(self.table)
+
+        if self.using:
+            store = store.using(*self.using)
+
+        spec = (Count(), Max(column))
+
+        if self.where:
+            count, latest = store.find(spec, self.where).one()
+        else:
+            count, latest = store.find(spec).one()
+
+        # The aggregate has no column type, convert it like the column.
+        if latest is not None:
+            variable = column.variable_factory()
+            variable.set(latest, from_db=True)
+            latest = variable.get()
+
+        return count, latest
+
+    def _count_key(self, entry=None):
+        '''
+        Get the count cache key for this query.
+
+        @keyword entry: Statement cache entry of the count, the where clause
+            is compiled if this is not specified.
+        @return: C{tuple} of the compiled where clause, its parameters and
+            the query options.
+        @raise TypeError: If a parameter can not be used as a key.
+        '''
+        if entry is not None:
+            params = tuple((self.params[x].variable if isinstance(x, int)
+                            else x).get(to_db=True) for x in entry[1])
+            key = (entry[0], params)
+        else:
+            state = State()
+            sql = storm_compile(self.where, state) if self.where else None
+            params = tuple(var.get(to_db=True) for var in state.parameters)
+            key = (sql, params, repr(self.using), self.distinct)
+
+        hash(key)
+        return key
+
+
+def iter_unbuffered(result_set, batch_size=1000):
+    '''
+    Iterate over a storm result set with a server side cursor.
+
+    Storm buffers the whole result on the client when the query is executed.
+    On MySQL the query is run with an unbuffered cursor instead and the rows
+    are fetched L{batch_size} at a time. The connection can not be used for
+    anything else until the iteration is finished. Other databases fall back
+    to iterating over the result set.
+
+    @param result_set: Storm result set.
+    @keyword batch_size: Number of rows fetched at a time.
+    @return: Iterator of what iterating over L{result_set} would return.
+    '''
+    store = result_set._store
+
+    if not _unbuffered(store):
+        return iter(result_set)
+
+    state = State()
+    statement = store._connection.compile(result_set._get_select(), state)
+    return _iter_unbuffered(store, statement, state.parameters,
+                            result_set._find_spec, batch_size)
+
+
+def _unbuffered(store):
+    '''
+    Check if a store can run queries with an unbuffered cursor.
+
+    @param store: Storm store.
+    @return: C{bool}
+    '''
+    connection = store._connection
+    connection._ensure_connected()
+    return SSCursor is not None and isinstance(connection._raw_connection,
+                                               MySQLConnection)
+
+
+def _iter_unbuffered(store, statement, params, find_spec, batch_size):
+    '''
+    Generator behind L{iter_unbuffered}. The statement is reported to the
+    storm tracers like the statements storm runs itself, so it shows up in
+    the query profiles and the slow log. Its time is the time to start the
+    query, the rows are fetched while iterating.
+
+    @param store: Storm store.
+    @param statement: SQL statement with ? parameter marks.
+    @param params: Storm variables of the statement parameters.
+    @param find_spec: Storm find spec loading the rows.
+    @param batch_size: Number of rows fetched at a time.
+    '''
+    connection = store._connection
+    statement = convert_param_marks(statement, '?', connection.param_mark)
+    raw_cursor = connection._raw_connection.cursor(SSCursor)
+    raw_cursor.arraysize = batch_size
+
+    try:
+        trace('connection_raw_execute', connection, raw_cursor, statement,
+              params)
+
+        try:
+            raw_cursor.execute(statement,
+                               tuple(connection.to_database(params)))
+        except Exception as execp:
+            trace('connection_raw_execute_error', connection, raw_cursor,
+                  statement, params, execp)
+            raise
+
+        trace('connection_raw_execute_success', connection, raw_cursor,
+              statement, params)
+        result = connection.result_factory(connection, raw_cursor)
+
+        for values in result:
+            yield find_spec.load_objects(store, result, values)
+    finally:
+        raw_cursor.close()
+
+
+def estimate_rows(store, table):
+    '''
+    Get the row count estimate for the table of a storm class from the MySQL
+    table statistics.
+
+    @param store: Store to query.
+    @param table: Storm class.
+    @return: Estimated number of rows.
+    '''
+    result = store.execute("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                           "WHERE TABLE_SCHEMA = DATABASE() AND "
+                           "TABLE_NAME = ?", (table.__storm_table__,))
+    row = result.get_one()
+    return int(row[0]) if row and row[0] is not None else 0
+
+
+def invalidate_counts(cls):
+    '''
+    Drop the cached counts for a storm class.
+
+    @param cls: Storm class.
+    '''
+    __counts__.pop(cls, None)
+
+
+def get_session():
+    '''
+    Get the request session for the current thread.
+
+    @return: The active L{Session} or None if there is no active session.
+    '''
+    return getattr(threading.currentThread(), 'stormy_session', None)
+
+
+class Session(object):
+    '''
+    Request scoped database session.
+
+    Starting a session does not touch the database. The first L{Stormy}
+    instance created inside the session borrows a store from the pool. When
+    the session ends the transaction is rolled back and the store is returned
+    to the pool, but only if the session was used.
+
+    @ivar stormy: The L{Stormy} instance used in this session, None if the
+        session has not been used.
+    @ivar readonly: Use a replica for the whole session.
+    @ivar committed: Has a transaction with writes been committed in this
+        session? Such a session can not be retried.
+    '''
+    stormy = None
+    committed = False
+    # Set on a session entered while another one is active, it leaves the
+    # store to the outer session.
+    _nested = False
+    _streaming = False
+
+    def __init__(self, readonly=False):
+        '''
+        @keyword readonly: Use a replica for the whole session.
+        '''
+        self.readonly = readonly
+
+    def __enter__(self):
+        '''
+        Make this the current session unless one is already active.
+        '''
+        thread = threading.currentThread()
+
+        if getattr(thread, 'stormy_session', None) is not None:
+            self._nested = True
+            return self
+
+        thread.stormy_session = self
+        return self
+
+    def __exit__(self, *_):
+        '''
+        Release the session and roll back any pending transaction.
+        '''
+        if self._nested:
+            return
+
+        threading.currentThread().stormy_session = None
+
+        if self.stormy is not None and not self._streaming:
+            self.stormy.release()
+
+    @property
+    def used(self):
+        '''
+        Has the database been used in this session?
+        '''
+        return self.stormy is not None
+
+    def reset(self):
+        '''
+        Close the stores of this session after a lost connection, the next
+        L{Stormy} instance borrows new ones.
+
+        @return: False if the session committed or has pending writes, which
+            a retry would repeat or lose, see L{call_with_retries}.
+        '''
+        if self.stormy is None:
+            return not self.committed
+
+        wrote = self.committed or self.stormy.writing()
+        self.stormy.release(discard=True)
+        self.stormy = None
+        return not wrote
+
+    def stream(self, body):
+        '''
+        Keep the session open while a response body is iterated.
+
+        Streamed bodies run their queries after the route has returned, the
+        session is made current again for the iteration and released when
+        the body is closed instead of when the session ends.
+
+        @param body: Response body iterator.
+        @return: Iterable to return as the response body.
+        '''
+        if self._nested:
+            return body
+
+        self._streaming = True
+        return SessionStream(self, body)
+
+
+class SessionStream(object):
+    '''
+    Response body that runs in a L{Session}, see L{Session.stream}.
+    '''
+
+    def __init__(self, session, body):
+        '''
+        @param session: Session to use while iterating.
+        @param body: Response body iterator.
+        '''
+        self.session = session
+        self.body = iter(body)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        ''' Get the next chunk of the body with the session current '''
+        thread = threading.currentThread()
+        thread.stormy_session = self.session
+
+        try:
+            return next(self.body)
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            thread.stormy_session = None
+
+    def close(self):
+        ''' Close the body and release the session '''
+        session, self.session = self.session, None
+
+        if session is None:
+            return
+
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            if session.stormy is not None:
+                session.stormy.release()
+
+
+class TrackingStore(Store):
+    '''
+    Store that remembers which classes it flushed in the current
+    transaction. Storm flushes pending changes before every query, so the
+    dirty objects alone do not tell if a transaction wrote.
+
+    @ivar flushed: C{set} of the classes of the objects flushed since the
+        last commit or rollback.
+    '''
+
+    def __init__(self, database, cache=None):
+        '''
+        @param database: Storm database.
+        @keyword cache: Storm cache, see L{Store}.
+        '''
+        Store.__init__(self, database, cache)
+        self.flushed = set()
+
+    def flush(self):
+        ''' Flush the dirty objects and remember their classes '''
+        # Recorded first, a flush that fails may have written some of them.
+        self.flushed.update(info.cls_info.cls for info in self._dirty)
+        Store.flush(self)
+
+    def commit(self):
+        ''' Commit and forget the flushed classes '''
+        Store.commit(self)
+        self.flushed.clear()
+
+    def rollback(self):
+        ''' Roll back and forget the flushed classes '''
+        Store.rollback(self)
+        self.flushed.clear()
+
+
+class StorePool(object):
+    '''
+    Bounded pool of storm stores, each with its own database connection.
+
+    @ivar size: Maximum number of stores.
+    @ivar max_idle: Seconds an unused store is kept before it is closed.
+    @ivar max_lifetime: Seconds after which a store is closed instead of
+        being returned to the pool.
+    @ivar timeout: Seconds to wait for a store when the pool is exhausted.
+    @ivar stats: C{dict} of counters: checkouts, waits, timeouts, created,
+        closed and ping_failures.
+    '''
+
+    def __init__(self, database, size=10, max_idle=300, max_lifetime=3600,
+                 timeout=30):
+        '''
+        Setup the pool. Stores are created on demand.
+
+        @param database: Storm database to create stores for.
+        @keyword size: Maximum number of stores.
+        @keyword max_idle: Seconds an unused store is kept.
+        @keyword max_lifetime: Maximum age of a store in seconds.
+        @keyword timeout: Seconds to wait for a store.
+        '''
+        self.database = database
+        self.size = size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.stats = dict.fromkeys(('checkouts', 'waits', 'timeouts',
+                                    'created', 'closed', 'ping_failures'), 0)
+        self._idle = collections.deque()
+        self._created = dict()
+        self._pending = 0
+        self._cond = threading.Condition()
+
+    def status(self):
+        '''
+        Get the pool counters and current usage.
+
+        @return: C{dict} of L{stats} plus size, open, idle and in_use.
+        '''
+        with self._cond:
+            status = dict(self.stats)
+            status['size'] = self.size
+            status['open'] = len(self._created) + self._pending
+            status['idle'] = len(self._idle)
+            status['in_use'] = len(self._created) - len(self._idle)
+
+        return status
+
+    def checkout(self):
+        '''
+        Borrow a store. Idle stores are checked with a ping before they are
+        handed out.
+
+        @return: Storm store.
+        @raise InternalException: If no store is free within L{timeout}.
+        '''
+        deadline = None
+        expired = []
+
+        try:
+            with self._cond:
+                self.stats['checkouts'] += 1
+
+                while True:
+                    expired.extend(self._reap())
+
+                    if self._idle:
+                        store = self._idle.pop()[0]
+                        break
+
+                    if len(self._created) + self._pending < self.size:
+                        # Reserve the slot while connecting outside the lock.
+                        self._pending += 1
+                        store = None
+                        break
+
+                    now = time.time()
+
+                    if deadline is None:
+                        self.stats['waits'] += 1
+                        deadline = now + self.timeout
+                    elif now >= deadline:
+                        self.stats['timeouts'] += 1
+                        raise exceptions.InternalException(
+                            "Timed out waiting for a database connection")
+
+                    self._cond.wait(deadline - now)
+        finally:
+            for old in expired:
+                self._disconnect(old)
+
+        if store is None:
+            return self._create()
+
+        return self._ping(store)
+
+    def checkin(self, store, discard=False):
+        '''
+        Roll back and return a store to the pool.
+
+        @param store: Store from L{checkout}.
+        @keyword discard: Close the store instead, used for stores that lost
+            their connection.
+        '''
+        if discard:
+            self._close(store)
+            return
+
+        try:
+            store.rollback()
+        except Exception:  # pylint: disable=W0703
+            logger.Logger(__name__).warn("Rollback failed, closing store")
+            self._close(store)
+            return
+
+        with self._cond:
+            expired = time.time() - self._created[store] > self.max_lifetime
+
+            if expired:
+                self._forget(store)
+            else:
+                self._idle.append((store, time.time()))
+                self._cond.notify()
+
+        if expired:
+            self._disconnect(store)
+
+    def _create(self):
+        '''
+        Open a new store in a slot reserved by L{checkout}.
+
+        @return: New storm store.
+        '''
+        try:
+            store = TrackingStore(self.database)
+        except Exception:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._pending -= 1
+            self._created[store] = time.time()
+            self.stats['created'] += 1
+
+        return store
+
+    def _ping(self, store):
+        '''
+        Make sure the connection of an idle store still works. Stores that
+        fail the ping for any reason are replaced. Called without the lock.
+
+        @param store: Store to check.
+        @return: Working store.
+        '''
+        try:
+            store.execute("DO 0", noresult=True)
+        except Exception:  # pylint: disable=W0703
+            msg = "Idle database connection failed, reconnecting"
+            logger.Logger(__name__).warn(msg)
+        else:
+            return store
+
+        with self._cond:
+            self.stats['ping_failures'] += 1
+            self._forget(store)
+            # Keep the slot for the new store, _create releases it on error.
+            self._pending += 1
+
+        self._disconnect(store)
+        return self._create()
+
+    def _reap(self):
+        '''
+        Take the stores that have been idle longer than L{max_idle} out of
+        the pool. Must be called with the lock held, the caller closes them
+        with L{_disconnect} after releasing it.
+
+        @return: C{list} of expired stores.
+        '''
+        now = time.time()
+        expired = []
+
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            store = self._idle.popleft()[0]
+            self._forget(store)
+            expired.append(store)
+
+        return expired
+
+    def _forget(self, store):
+        '''
+        Free the slot of a store. Must be called with the lock held.
+
+        @param store: Store leaving the pool.
+        '''
+        if self._created.pop(store, None) is not None:
+            self.stats['closed'] += 1
+            self._cond.notify()
+
+    @staticmethod
+    def _disconnect(store):
+        '''
+        Close the connection of a store, ignoring errors.
+
+        @param store: Store to close.
+        '''
+        try:
+            store.close()
+        except Exception:  # pylint: disable=W0703
+            pass
+
+    def _close(self, store):
+        '''
+        Close a store and free its slot.
+
+        @param store: Store to close.
+        '''
+        try:
+            self._disconnect(store)
+        finally:
+            with self._cond:
+                self._forget(store)
+
+
+class Keyset(object):
+    '''
+    Keyset (cursor) pagination over a sort column and the primary key.
+
+    Pages are selected with a WHERE on the sort key of the last row of the
+    previous page instead of an OFFSET, so every page costs the same with an
+    index on the sort column. NULL sort values are paged as the lowest
+    values, the order MySQL and SQLite sort them in.
+
+    @ivar columns: Sort column followed by the primary key columns.
+    @ivar sort: Name of the sort column or None.
+    @ivar desc: Descending order.
+    '''
+
+    def __init__(self, stype, sort=None, desc=False):
+        '''
+        @param stype: Storm class being paged.
+        @keyword sort: Name of the sort column, the primary key is used alone
+            if this is None.
+        @keyword desc: Page in descending order.
+        '''
+        self.sort = sort
+        self.desc = desc
+        self.columns = tuple(get_cls_info(stype).primary_key)
+
+        if sort is not None:
+            self.columns = (getattr(stype, sort),) + self.columns
+
+    def where(self, values):
+        '''
+        Build the expression selecting rows after L{values}.
+
+        @param values: Sort key values of the last row of the previous page.
+        @return: Storm expression.
+        '''
+        terms = []
+
+        for index, column in enumerate(self.columns):
+            value = values[index]
+
+            if value is None:
+                # Only the sort column can be NULL. Ascending the other rows
+                # come after the NULLs, descending nothing does.
+                if self.desc:
+                    continue
+
+                term = column != None
+            elif self.desc:
+                term = column < value
+
+                if index == 0 and self.sort is not None:
+                    term = Or(term, column == None)
+            else:
+                term = column > value
+
+            if index:
+                term = And(*[self.columns[i] == values[i]
+                             for i in xrange(index)] + [term])
+
+            terms.append(term)
+
+        return Or(*terms) if len(terms) > 1 else terms[0]
+
+    def encode(self, obj):
+        '''
+        Create the cursor pointing after L{obj}.
+
+        @param obj: Last object on the page.
+        @return: Opaque cursor string.
+        '''
+        return self.encode_values([column.__get__(obj)
+                                   for column in self.columns])
+
+    def encode_values(self, row):
+        '''
+        Create the cursor pointing after the row with the sort key L{row}.
+
+        @param row: Values of L{columns} for the last row on the page.
+        @return: Opaque cursor string.
+        '''
+        values = []
+
+        for value in row:
+            if isinstance(value, datetime.datetime):
+                value = {'datetime': value.strftime('%Y-%m-%d %H:%M:%S.%f')}
+
+            values.append(value)
+
+        data = json.dumps({'sort': self.sort, 'desc': self.desc,
+                           'values': values})
+        return base64.urlsafe_b64encode(data)
+
+    def decode(self, cursor):
+        '''
+        Get the sort key values from a cursor made by L{encode}.
+
+        @param cursor: Cursor string.
+        @return: C{list} of sort key values.
+        @raise RequestException: If the cursor is invalid or was made for a
+            different sort.
+        '''
+        try:
+            data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            values = data['values']
+
+            for index, value in enumerate(values):
+                if isinstance(value, dict):
+                    values[index] = datetime.datetime.strptime(
+                        value['datetime'], '%Y-%m-%d %H:%M:%S.%f')
+        except (TypeError, ValueError, KeyError):
+            raise exceptions.RequestException("Invalid cursor")
+
+        if (data.get('sort') != self.sort or data.get('desc') != self.desc
+                or len(values) != len(self.columns)):
+            raise exceptions.RequestException("Cursor does not match sort")
+
+        for index, (column, value) in enumerate(zip(self.columns, values)):
+            if value is None:
+                if index == 0 and self.sort is not None:
+                    continue
+
+                raise exceptions.RequestException("Invalid cursor")
+
+            try:
+                column.variable_factory(value=value)
+            except (TypeError, ValueError):
+                raise exceptions.RequestException("Invalid cursor")
+
+        return values
+
+
+class Stormy(object):  # pylint: disable=R0903
+    '''
+    Stateful class for accessing storm.
+
+    Each thread borrows a store from the L{StorePool} the first time it uses
+    Stormy. Inside a L{Session} the store is returned when the session ends,
+    otherwise it is kept until L{release} is called.
+
+    When replica DSNs are configured in woodstove.storm.replicas, L{reader}
+    hands out replica stores for read only queries and read only sessions
+    use a replica for everything.
+    '''
+
+    # pylint: disable=W0212
+
+    _pool = None
+    _replicas = ()
+
+    @stateful.threadstate
+    def __init__(self, dsn=None):
+        ''' Setup or fetch state '''
+        self.conf = config.Config().woodstove.storm
+        if not self.__class__._pool:
+            if not dsn:
+                dsn = self.conf.dsn
+
+            if self.conf.debug:
+                debug(True, stream=open(self.conf.file, 'a+'))
+
+            opts = self.conf.dict
+            profiler.install(opts)
+            self.__class__._replicas = tuple(
+                _create_pool(replica, opts)
+                for replica in opts.get('replicas') or ())
+            self.__class__._pool = _create_pool(dsn, opts)
+        self.store = None
+        self.replica = None
+        self._store_pool = None
+        self._replica_pool = None
+        self._written = set()
+
+    def __stateinit__(self, dsn=None):  # pylint: disable=W0613
+        ''' per instance setup '''
+        session = get_session()
+
+        if session is not None:
+            if session.used:
+                return
+
+            session.stormy = self
+
+        if self.store is None:
+            if session is not None and session.readonly and self._replicas:
+                self._store_pool = random.choice(self._replicas)
+            else:
+                self._store_pool = self._pool
+
+            self.store = self._store_pool.checkout()
+        elif session is not None:
+            # If we get here with a pending transaction we don't want to
+            # keep it.
+            self.store.rollback()
+            self._written.clear()
+
+    def __getattr__(self, name):
+        ''' pass request into storm '''
+        return getattr(self.store, name)
+
+    def add(self, obj):
+        ''' Add `obj` to the store and remember its class was written '''
+        self._written.add(obj.__class__)
+        return self.store.add(obj)
+
+    def remove(self, obj):
+        ''' Remove `obj` from the store and remember its class was
+            written '''
+        self._written.add(obj.__class__)
+        return self.store.remove(obj)
+
+    def mark_written(self, cls):
+        ''' Remember that objects of `cls` were changed in the current
+            transaction '''
+        self._written.add(cls)
+
+    def primary(self):
+        ''' Does this instance use the primary database? '''
+        return self._store_pool is self._pool
+
+    def writing(self):
+        ''' Does the current transaction have writes, flushed or not? '''
+        return bool(self._written or self.store._dirty or
+                    self.store.flushed)
+
+    def commit(self):
+        ''' Commit, start the read-your-writes window and drop the cached
+            counts for the written classes '''
+        written = self._written | self.store.flushed | set(
+            info.cls_info.cls for info in self.store._dirty)
+        session = get_session()
+
+        # Set before committing, a commit that loses the connection may
+        # still have been applied.
+        if written and session is not None:
+            session.committed = True
+
+        self.store.commit()
+        self._written.clear()
+        now = time.time()
+
+        for cls in written:
+            __written__[cls] = now
+            invalidate_counts(cls)
+
+    def rollback(self):
+        ''' Roll back the current transaction '''
+        self._written.clear()
+        self.store.rollback()
+
+    def reader(self, cls=None):
+        '''
+        Get a store for a read only query.
+
+        Reads go to a replica unless there are no replicas, the current
+        transaction has pending writes, or L{cls} was written by a commit less
+        than woodstove.storm.replica_window seconds ago.
+
+        @keyword cls: Storm class being read.
+        @return: Replica store or this instance.
+        '''
+        if not self._replicas or self._store_pool is not self._pool:
+            return self
+
+        if self.writing():
+            return self
+
+        if cls is not None:
+            window = self.conf.dict.get('replica_window', 5)
+
+            if time.time() - __written__.get(cls, 0) < window:
+                return self
+
+        if self.replica is None:
+            self._replica_pool = random.choice(self._replicas)
+            self.replica = self._replica_pool.checkout()
+
+        return self.replica
+
+    def release(self, discard=False):
+        ''' Roll back and return this thread's stores to the pool, or close
+            them if `discard` is set '''
+        store, self.store = self.store, None
+        replica, self.replica = self.replica, None
+        self._written.clear()
+
+        if store is not None:
+            self._store_pool.checkin(store, discard)
+
+        if replica is not None:
+            self._replica_pool.checkin(replica, discard)
+
+
+def _create_pool(dsn, opts):
+    '''
+    Create a store pool for a DSN using the pool settings in L{opts}.
+
+    @param dsn: Database DSN.
+    @param opts: C{dict} of woodstove.storm settings.
+    @return: New L{StorePool}.
+    '''
+    return StorePool(create_database(dsn),
+                     size=opts.get('pool_size', 10),
+                     max_idle=opts.get('pool_max_idle', 300),
+                     max_lifetime=opts.get('pool_max_lifetime', 3600),
+                     timeout=opts.get('pool_timeout', 30))
+
+
+def pool_stats():
+    '''
+    Get the connection pool counters.
+
+    @return: C{dict} from L{StorePool.status}, with the replica pools under
+        'replicas', or None if the pool has not been set up yet.
+    '''
+    if Stormy._pool is None:
+        return None
+
+    status = Stormy._pool.status()
+
+    if Stormy._replicas:
+        status['replicas'] = [pool.status() for pool in Stormy._replicas]
+
+    status['retries'] = dict(__retries__)
+    return status
+
+
+def statement_stats():
+    '''
+    Get the compiled statement cache counters.
+
+    @return: C{dict} of hits, misses, the seconds spent compiling on misses
+        and the number of cached statements.
+    '''
+    stats = dict(__statement_stats__)
+    stats['size'] = len(__statements__)
+    return stats
+
+
+def call_with_retries(func, reset, *args, **kwargs):
+    '''
+    Call L{func}, calling it again on new connections when the database
+    connection is lost.
+
+    Up to woodstove.storm.retries (default 2) retries are made after a random
+    delay of up to woodstove.storm.retry_backoff (default 0.1) seconds,
+    doubled on every retry. Calls made while another call is retrying are
+    not retried themselves, the outer call retries them.
+
+    @param func: Function to call, it must be safe to call again.
+    @param reset: Function dropping the lost connection before a retry. It
+        returns False if the call can not be retried.
+    @param *args: Positional arguments for L{func}.
+    @param **kwargs: Keyword arguments for L{func}.
+    @return: Return value of L{func}.
+    @raise DisconnectionError: If the last retry failed too.
+    '''
+    thread = threading.currentThread()
+
+    if getattr(thread, 'stormy_retrying', False):
+        return func(*args, **kwargs)
+
+    opts = config.Config().woodstove.storm.dict
+    retries = opts.get('retries', 2)
+    backoff = opts.get('retry_backoff', 0.1)
+    attempt = 0
+    thread.stormy_retrying = True
+
+    try:
+        while True:
+            try:
+                ret = func(*args, **kwargs)
+            except DisconnectionError:
+                if attempt >= retries or not reset():
+                    if attempt:
+                        __retries__['failed'] += 1
+                    raise
+
+                attempt += 1
+                __retries__['retries'] += 1
+                logger.Logger(__name__).warn(
+                    "Lost database connection in %s, retry %d" % (
+                        func.__name__, attempt))
+                time.sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
+                continue
+
+            if attempt:
+                __retries__['recovered'] += 1
+
+            return ret
+    finally:
+        thread.stormy_retrying = False
+
+
+def _reset_reader():
+    '''
+    Drop the current thread's stores before retrying a read, unless the
+    transaction has changes that would be lost.
+
+    @return: False if the read can not be retried.
+    '''
+    state = Stormy()
+
+    if state.writing():
+        return False
+
+    session = get_session()
+
+    if session is not None:
+        return session.reset()
+
+    state.release(discard=True)
+    return True
+
+
+def idempotent(func):
+    '''
+    Decorator for database reads that can be retried on a new connection
+    when the connection is lost, see L{call_with_retries}.
+
+    @param func: Read function.
+    @return: Retrying function.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        '''
+        Call L{func} with retries.
+        '''
+        return call_with_retries(func, _reset_reader, *args, **kwargs)
+
+    return wrapper
+
+
+def required(obj, funcs=None):
+    ''' setup required for `obj` '''
     if not funcs:
         funcs = ('create', 'replace')
 
@@ -300,3 +2172,9 @@ def hidden(obj):
     ''' Flag obj as hidden '''
     obj._stove_hidden = True
     return obj
+
+
+def version(obj):
+    ''' Flag obj as the version column, see `row_version` '''
+    obj._stove_version = True
+    return obj
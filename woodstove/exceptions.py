@@ -68,3 +68,11 @@ class AuthException(BaseWoodstoveException):
 
 class InternalException(BaseWoodstoveException):
     ''' Internal error '''
+
+
+class PreconditionException(BaseWoodstoveException):
+    ''' Request precondition failed '''
+
+
+class ConflictException(BaseWoodstoveException):
+    ''' Request conflicts with existing data '''
@@ -34,6 +34,7 @@ from woodstove.common import logger, config
 
 __hooks__ = dict()
 __plugins__ = list()
+__hook_generation__ = 0
 
 
 def load_plugins():
@@ -56,12 +57,33 @@ def get_hook_table(name):
     return __hooks__.setdefault(name, dict())
 
 
+def hook_generation():
+    ''' Get the hook generation. It changes every time a hook table is
+        modified so cached copies of the hooks can detect they are stale '''
+    return __hook_generation__
+
+
+def _bump_generation():
+    ''' Invalidate cached copies of the hook tables '''
+    global __hook_generation__
+    __hook_generation__ += 1
+
+
+def get_hooks(table_name, hook_name):
+    ''' Get the `hook_name` hooks in the `table_name` table as a tuple '''
+    try:
+        return tuple(__hooks__[table_name][hook_name])
+    except KeyError:
+        return ()
+
+
 def register_hook(table_name, hook_name, func):
     ''' Register `func` as in the `hook_name` hook in the `table_name`
         table '''
     table = get_hook_table(table_name)
     hook = table.setdefault(hook_name, set())
     hook.add(func)
+    _bump_generation()
 
 
 def remove_hook(table_name, hook_name, func):
@@ -70,6 +92,7 @@ def remove_hook(table_name, hook_name, func):
     table = get_hook_table(table_name)
     hook_table = table.setdefault(hook_name, set())
     hook_table.discard(func)
+    _bump_generation()
 
 
 def hook(table, name):
@@ -103,8 +126,21 @@ def call_hooks(table_name, hook_name, *args, **kwargs):
     @raise Exception: Any exceptions raised by the hooks will be logged and
         reraised by this function.
     '''
-    table = get_hook_table(table_name)
-    for hook in table.get(hook_name, list()):
+    run_hooks(get_hooks(table_name, hook_name), *args, **kwargs)
+
+
+def run_hooks(hooks, *args, **kwargs):
+    '''
+    Call every function in `hooks`. This is used by callers that resolve
+    their hooks ahead of time with L{get_hooks}.
+
+    @param hooks: Iterable of hook functions.
+    @param *args: Positional arguments to pass into hook functions.
+    @param **kwargs: Keyword arguments to pass into hook functions.
+    @raise Exception: Any exceptions raised by the hooks will be logged and
+        reraised by this function.
+    '''
+    for hook in hooks:
         try:
             hook(*args, **kwargs)
         except BaseException as execp: